@@ -11,7 +11,9 @@ export interface IEpisode {
     transcripts: {
         transcript: {
             results: { offset: string, alternatives: string[] }[]
-        }
+        },
+        start_offset?: number,
+        absolute_offsets?: boolean
     }[][]
     files: string[],
     remote: string,
@@ -147,7 +149,9 @@ class EpisodeDisplay extends Component<IEpisodeDisplayProps, IEpisodeDisplayStat
                                         return this.props.collapseAfter === undefined || j <= this.props.collapseAfter
                                     })
                                     .map(({s, trueJ}, j: number) => {
-                                        const trueOffset = this.offsetTimeString(s.offset, (i * 3600) - 30)
+                                        // older transcripts restart their offsets at every hour-long part
+                                        const partStart = e.transcripts[i][0].absolute_offsets ? 0 : i * 3600
+                                        const trueOffset = this.offsetTimeString(s.offset, partStart - 30)
                                         const text = (s.alternatives || [])[0] || "";
                                         return <div
                                             key={"" + i + "_" + j}
@@ -1,63 +1,206 @@
+import os
+import threading
+import time
+from concurrent.futures import Future
+from typing import Optional
+
 from google.api_core import client_options
 from google.cloud.speech_v2 import SpeechClient, BatchRecognizeResponse
 from google.cloud.speech_v2.types import cloud_speech
 
 from google_cloud_storage_manager import gc_project_name, gc_bucket_name
+from services.audio_processing import TRANSCRIPTION_SAMPLE_RATE
 
+# files sent in one BatchRecognize request, how long a partial batch waits for more files,
+# and how many requests may be running at the same time
+TRANSCRIBE_BATCH_SIZE = int(os.getenv("TRANSCRIBE_BATCH_SIZE", 10))
+TRANSCRIBE_BATCH_WAIT = float(os.getenv("TRANSCRIBE_BATCH_WAIT", 30))
+TRANSCRIBE_MAX_OPERATIONS = int(os.getenv("TRANSCRIBE_MAX_OPERATIONS", 4))
+TRANSCRIBE_TIMEOUT = 12000
 
-def transcribe_batch_gcs_input_inline_output_v2(
-        gcs_object: str,
-) -> list[dict]:
-    """Transcribes audio from a Google Cloud Storage URI.
+# explicit decoding for the formats prepared by services.audio_processing.prepare_for_transcription
+EXPLICIT_ENCODINGS = {
+    "flac": cloud_speech.ExplicitDecodingConfig.AudioEncoding.FLAC,
+    "opus": cloud_speech.ExplicitDecodingConfig.AudioEncoding.OGG_OPUS,
+}
 
-    Args:
-        gcs_object: The Google Cloud Storage file name.
+_speech_client = None
+_speech_client_lock = threading.Lock()
 
-    Returns:
-        The list[dict].
-    """
-    # Instantiates a client
-    client_options_var = client_options.ClientOptions(
-        api_endpoint="us-central1-speech.googleapis.com"
-    )
 
-    client = SpeechClient(
-        client_options=client_options_var
-    )
+def speech_client() -> SpeechClient:
+    """Process-wide client, so every request reuses the same gRPC channel."""
+    global _speech_client
+    with _speech_client_lock:
+        if _speech_client is None:
+            _speech_client = SpeechClient(
+                client_options=client_options.ClientOptions(api_endpoint="us-central1-speech.googleapis.com")
+            )
+        return _speech_client
+
+
+def decoding_config(audio_format: Optional[str] = None) -> dict:
+    if audio_format not in EXPLICIT_ENCODINGS:
+        return {"auto_decoding_config": cloud_speech.AutoDetectDecodingConfig()}
+    return {"explicit_decoding_config": cloud_speech.ExplicitDecodingConfig(
+        encoding=EXPLICIT_ENCODINGS[audio_format],
+        sample_rate_hertz=TRANSCRIPTION_SAMPLE_RATE,
+        audio_channel_count=1,
+    )}
 
+
+def gcs_uri(gcs_object: str) -> str:
+    return f"gs://{gc_bucket_name}/" + gcs_object
+
+
+def submit_batch_recognize(gcs_objects: list[str], audio_format: Optional[str] = None):
     config = cloud_speech.RecognitionConfig(
-        auto_decoding_config=cloud_speech.AutoDetectDecodingConfig(),
+        **decoding_config(audio_format),
         language_codes=["iw-IL"],
         model="chirp_2",
     )
 
-    gcs_uri = f"gs://{gc_bucket_name}/" + gcs_object
-
-    file_metadata = cloud_speech.BatchRecognizeFileMetadata(uri=gcs_uri)
-
     request = cloud_speech.BatchRecognizeRequest(
         recognizer=f"projects/{gc_project_name}/locations/us-central1/recognizers/_",
         config=config,
-        files=[file_metadata],
+        files=[cloud_speech.BatchRecognizeFileMetadata(uri=gcs_uri(o)) for o in gcs_objects],
         recognition_output_config=cloud_speech.RecognitionOutputConfig(
             inline_response_config=cloud_speech.InlineOutputConfig(),
         ),
         processing_strategy=cloud_speech.BatchRecognizeRequest.ProcessingStrategy.DYNAMIC_BATCHING,
     )
 
-    # Transcribes the audio into text
-    operation = client.batch_recognize(request=request)
+    return speech_client().batch_recognize(request=request)
 
-    print("Waiting for transcription to complete...")
-    response: BatchRecognizeResponse = operation.result(timeout=12000)
 
-    response_as_json = [{
+def format_file_result(file_result) -> list[dict]:
+    return [{
         "transcript": {
             "results": [{
                 "offset": str(r2.result_end_offset),
                 "alternatives": [a.transcript for a in r2.alternatives]
-            } for r2 in response.results[r].transcript.results],
+            } for r2 in file_result.transcript.results],
         }
-    } for r in response.results]
+    }]
+
+
+def transcribe_batch_gcs_input_inline_output_v2(
+        gcs_object: str,
+        audio_format: Optional[str] = None,
+) -> list[dict]:
+    """Transcribes audio from a Google Cloud Storage URI.
+
+    Args:
+        gcs_object: The Google Cloud Storage file name.
+        audio_format: "flac" or "opus" for prepared 16kHz mono audio, None to let the API detect the encoding.
+
+    Returns:
+        The list[dict].
+    """
+    # Transcribes the audio into text
+    operation = submit_batch_recognize([gcs_object], audio_format)
+
+    print("Waiting for transcription to complete...")
+    response: BatchRecognizeResponse = operation.result(timeout=TRANSCRIBE_TIMEOUT)
+
+    response_as_json = []
+    for r in response.results:
+        response_as_json.extend(format_file_result(response.results[r]))
 
     return response_as_json
+
+
+class OperationFailed(Exception):
+    """A BatchRecognize operation that finished with an error, as opposed to a failure to check on it."""
+
+
+def collect_batch_recognize(operation_name: str) -> Optional[dict]:
+    """Checks a previously submitted operation without waiting for it.
+
+    Returns None while it is still running, otherwise {gcs uri: list[dict] transcript, or the error message
+    of that file}. Raises OperationFailed when the whole operation failed.
+    """
+    operation = speech_client().get_operation(request={"name": operation_name})
+    if not operation.done:
+        return None
+    if operation.HasField("error"):
+        raise OperationFailed(operation.error.message)
+    response = BatchRecognizeResponse.deserialize(operation.response.value)
+    return {
+        uri: response.results[uri].error.message if response.results[uri].error.code
+        else format_file_result(response.results[uri])
+        for uri in response.results
+    }
+
+
+class BatchTranscriber:
+    """Groups files submitted from any thread into multi-file BatchRecognize requests.
+
+    submit() returns a Future resolving to the same list[dict] transcribe_batch_gcs_input_inline_output_v2
+    returns for that file. A batch is sent once it holds batch_size files of the same audio format or its
+    oldest file has waited max_wait seconds, with at most max_operations requests in flight.
+    """
+    remote = True
+
+    def __init__(self, batch_size: int = TRANSCRIBE_BATCH_SIZE, max_wait: float = TRANSCRIBE_BATCH_WAIT,
+                 max_operations: int = TRANSCRIBE_MAX_OPERATIONS):
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self._pending: dict[Optional[str], list[tuple[str, Future, float]]] = {}
+        self._pending_changed = threading.Condition()
+        self._operations = threading.Semaphore(max_operations)
+        self._dispatcher = None
+
+    def submit(self, gcs_object: str, audio_format: Optional[str] = None) -> Future:
+        future = Future()
+        with self._pending_changed:
+            self._pending.setdefault(audio_format, []).append((gcs_object, future, time.time()))
+            if self._dispatcher is None:
+                self._dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+                self._dispatcher.start()
+            self._pending_changed.notify()
+        return future
+
+    def _take_batch(self) -> tuple[Optional[str], list[tuple[str, Future, float]]]:
+        with self._pending_changed:
+            while True:
+                now = time.time()
+                oldest = None
+                for audio_format, files in self._pending.items():
+                    if not files:
+                        continue
+                    if len(files) >= self.batch_size or now - files[0][2] >= self.max_wait:
+                        batch = files[:self.batch_size]
+                        self._pending[audio_format] = files[self.batch_size:]
+                        return audio_format, batch
+                    oldest = files[0][2] if oldest is None else min(oldest, files[0][2])
+                self._pending_changed.wait(None if oldest is None else oldest + self.max_wait - now)
+
+    def _dispatch(self):
+        while True:
+            audio_format, batch = self._take_batch()
+            self._operations.acquire()
+            threading.Thread(target=self._run_batch, args=(audio_format, batch), daemon=True).start()
+
+    def _run_batch(self, audio_format: Optional[str], batch: list[tuple[str, Future, float]]):
+        try:
+            print("transcribing a batch of " + str(len(batch)) + " files")
+            operation = submit_batch_recognize([gcs_object for gcs_object, _, _ in batch], audio_format)
+            response: BatchRecognizeResponse = operation.result(timeout=TRANSCRIBE_TIMEOUT)
+            for gcs_object, future, _ in batch:
+                uri = gcs_uri(gcs_object)
+                if uri not in response.results:
+                    future.set_exception(RuntimeError("no transcription returned for " + uri))
+                elif response.results[uri].error.code:
+                    future.set_exception(RuntimeError(response.results[uri].error.message))
+                else:
+                    future.set_result(format_file_result(response.results[uri]))
+        except Exception as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            self._operations.release()
+
+
+batch_transcriber = BatchTranscriber()
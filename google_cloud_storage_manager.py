@@ -1,44 +1,109 @@
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Union
+
+from google.api_core.exceptions import NotFound
+from google.auth.credentials import AnonymousCredentials
 from google.cloud import storage
+from requests.adapters import HTTPAdapter
 
 gc_project_name = "glz-archives"
-gc_bucket_name = "glz-content"
+gc_bucket_name = os.getenv("GCS_BUCKET_NAME", "glz-content")
 
+# uploads running at the same time across the process, and the size of each resumable upload request;
+# the chunk size must be a multiple of 256KB
+GCS_UPLOAD_WORKERS = int(os.getenv("GCS_UPLOAD_WORKERS", 8))
+GCS_UPLOAD_CHUNK_SIZE = int(os.getenv("GCS_UPLOAD_CHUNK_SIZE", 8 * 1024 * 1024))
+GCS_UPLOAD_TIMEOUT = 120000
+# deletes sent in one batch request, the JSON API accepts up to 100
+GCS_DELETE_BATCH_SIZE = 100
+# points the client at a local fake GCS server (e.g. fsouza/fake-gcs-server) instead of Google Cloud Storage
+STORAGE_EMULATOR_HOST = os.getenv("STORAGE_EMULATOR_HOST")
+
+_storage_client = None
+_storage_client_lock = threading.Lock()
+_upload_executor = ThreadPoolExecutor(max_workers=GCS_UPLOAD_WORKERS, thread_name_prefix="gcs-upload")
+
+
+def storage_client() -> storage.Client:
+    """Process-wide client, so every upload and delete reuses the same authenticated connection pool."""
+    global _storage_client
+    with _storage_client_lock:
+        if _storage_client is None:
+            if STORAGE_EMULATOR_HOST:
+                _storage_client = storage.Client(
+                    project=gc_project_name,
+                    credentials=AnonymousCredentials(),
+                    client_options={"api_endpoint": STORAGE_EMULATOR_HOST},
+                )
+            else:
+                _storage_client = storage.Client(project=gc_project_name)
+            # one pooled connection per upload thread instead of requests' default of 10
+            adapter = HTTPAdapter(pool_connections=GCS_UPLOAD_WORKERS, pool_maxsize=GCS_UPLOAD_WORKERS)
+            _storage_client._http.mount("https://", adapter)
+            _storage_client._http.mount("http://", adapter)
+        return _storage_client
 
-def upload_blob(source_file_name, destination_blob_name):
-    """Uploads a file to the bucket."""
-    # The ID of your GCS bucket
-    # bucket_name = "your-bucket-name"
-    # The path to your file to upload
-    # source_file_name = "local/path/to/file"
-    # The ID of your GCS object
-    # destination_blob_name = "storage-object-name"
 
+def bucket() -> storage.Bucket:
+    return storage_client().bucket(gc_bucket_name)
+
+
+def upload_blob(source_file_name, destination_blob_name):
+    """Uploads a file to the bucket in resumable chunks of GCS_UPLOAD_CHUNK_SIZE, so a dropped connection
+    only resends the current chunk."""
     print(
         f"Uploading file {source_file_name} to {destination_blob_name}."
     )
 
-    storage_client = storage.Client(project=gc_project_name)
-    bucket = storage_client.bucket(gc_bucket_name)
-    blob = bucket.blob(destination_blob_name)
-
-    blob.upload_from_filename(source_file_name, timeout=120000)
+    blob = bucket().blob(destination_blob_name, chunk_size=GCS_UPLOAD_CHUNK_SIZE)
+    blob.upload_from_filename(str(source_file_name), timeout=GCS_UPLOAD_TIMEOUT)
 
     print(
         f"File {source_file_name} uploaded to {destination_blob_name}."
     )
 
 
+def start_uploads(files: list[tuple[Union[str, Path], str]]) -> list[Future]:
+    """Queues (source file, destination blob) uploads on the shared upload pool and returns right away."""
+    return [_upload_executor.submit(upload_blob, source, destination) for source, destination in files]
+
+
+def upload_blobs(files: list[tuple[Union[str, Path], str]]):
+    """Uploads all files in parallel; takes as long as the slowest file rather than the sum of all of them."""
+    futures = start_uploads(files)
+    for f in futures:
+        f.result()
+
+
 def delete_blob(blob_name):
     """Deletes a blob from the bucket."""
-    # bucket_name = "your-bucket-name"
-    # blob_name = "your-object-name"
-
     print(f"Deleting {blob_name} from Google Cloud Storage.")
 
-    storage_client = storage.Client(project=gc_project_name)
-
-    bucket = storage_client.bucket(gc_bucket_name)
-    blob = bucket.blob(blob_name)
-    blob.delete()
+    bucket().blob(blob_name).delete()
 
     print(f"Blob {blob_name} deleted.")
+
+
+def delete_blobs(blob_names: list[str]):
+    """Deletes the blobs in batch requests of GCS_DELETE_BATCH_SIZE; blobs that are already gone are skipped."""
+    if not blob_names:
+        return
+    print(f"Deleting {len(blob_names)} blobs from Google Cloud Storage.")
+    client = storage_client()
+    target = bucket()
+    for i in range(0, len(blob_names), GCS_DELETE_BATCH_SIZE):
+        chunk = blob_names[i:i + GCS_DELETE_BATCH_SIZE]
+        try:
+            with client.batch():
+                for name in chunk:
+                    target.blob(name).delete()
+        except NotFound:
+            # a batch raises for its first failed call, retry the rest one by one
+            for name in chunk:
+                try:
+                    target.blob(name).delete()
+                except NotFound:
+                    pass
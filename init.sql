@@ -12,13 +12,26 @@ CREATE TABLE `episode` (
   `data` longtext,
   `download_status` enum('not downloaded','in progress','error','downloaded') NOT NULL DEFAULT 'not downloaded',
   `err_msg` varchar(500) DEFAULT NULL,
+  `worker_id` varchar(150) DEFAULT NULL,
+  `lease_expires` datetime DEFAULT NULL,
   `local_storage` json DEFAULT NULL,
+  `segment_offsets` json DEFAULT NULL,
   `content_hash` varchar(150) DEFAULT NULL,
+  `remote_fingerprint` varchar(100) DEFAULT NULL,
+  `remote_etag` varchar(200) DEFAULT NULL,
   `duplicate_of` int DEFAULT NULL,
+  `partial_duplicate_of` int DEFAULT NULL,
+  `duplicate_spans` json DEFAULT NULL,
   `drive_url` json DEFAULT NULL,
+  `has_transcript` tinyint(1) NOT NULL DEFAULT 0,
   `transcripts` longtext,
+  `payload_version` int NOT NULL DEFAULT 0,
   PRIMARY KEY (`id`),
   UNIQUE KEY `unique_episode_guarantee` (`channel_id`,`programme_id_on_channel`,`episode_id_on_channel`),
+  KEY `air_date_id` (`air_date`,`id`),
+  KEY `worker_id` (`worker_id`),
+  KEY `remote_fingerprint` (`remote_fingerprint`),
+  KEY `content_hash` (`content_hash`),
   FULLTEXT KEY `transcripts_search` (`transcripts`)
 ) ENGINE=MyISAM AUTO_INCREMENT=5300 DEFAULT CHARSET=utf8mb3;
 
@@ -32,8 +45,9 @@ CREATE TABLE `highlights` (
   `fixed_text` text COLLATE utf8mb4_general_ci,
   `speaker_name` varchar(500) COLLATE utf8mb4_general_ci NOT NULL,
   `title` varchar(1000) COLLATE utf8mb4_general_ci DEFAULT NULL,
-  PRIMARY KEY (`id`)
-) ENGINE=MyISAM AUTO_INCREMENT=12 DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
+  PRIMARY KEY (`id`),
+  KEY `episode_id` (`episode_id`)
+) ENGINE=InnoDB AUTO_INCREMENT=12 DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
 
 CREATE TABLE `programme` (
   `id` int NOT NULL AUTO_INCREMENT,
@@ -45,3 +59,61 @@ CREATE TABLE `programme` (
   UNIQUE KEY `glz_id` (`glz_id`)
 ) ENGINE=MyISAM AUTO_INCREMENT=248 DEFAULT CHARSET=utf8mb3;
 
+
+CREATE TABLE `transcript_segment` (
+  `id` int NOT NULL AUTO_INCREMENT,
+  `episode_id` int NOT NULL,
+  `part` int NOT NULL,
+  `segment` int NOT NULL,
+  `start_offset` decimal(10,3) DEFAULT NULL,
+  `end_offset` decimal(10,3) DEFAULT NULL,
+  `text` text NOT NULL,
+  `normalized_text` text NOT NULL,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `episode_segment` (`episode_id`,`part`,`segment`),
+  FULLTEXT KEY `normalized_text_search` (`normalized_text`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
+
+CREATE TABLE `transcription_job` (
+  `id` int NOT NULL AUTO_INCREMENT,
+  `create_date` datetime DEFAULT CURRENT_TIMESTAMP,
+  `update_date` datetime DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  `episode_id` int NOT NULL,
+  `part` int NOT NULL,
+  `gcs_object` varchar(500) NOT NULL,
+  `audio_format` varchar(20) DEFAULT NULL,
+  `kept_intervals` json DEFAULT NULL,
+  `operation_name` varchar(500) NOT NULL,
+  `status` enum('submitted','done','error','stored') NOT NULL DEFAULT 'submitted',
+  `transcript` longtext,
+  `err_msg` varchar(500) DEFAULT NULL,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `episode_part` (`episode_id`,`part`),
+  KEY `operation_name` (`operation_name`),
+  KEY `status` (`status`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
+
+CREATE TABLE `episode_fingerprint` (
+  `episode_id` int NOT NULL,
+  `frames` int NOT NULL,
+  `fingerprint` mediumblob NOT NULL,
+  PRIMARY KEY (`episode_id`)
+) ENGINE=InnoDB;
+
+CREATE TABLE `fingerprint_landmark` (
+  `hash` int unsigned NOT NULL,
+  `episode_id` int NOT NULL,
+  `position` int NOT NULL,
+  PRIMARY KEY (`episode_id`,`position`),
+  KEY `hash` (`hash`)
+) ENGINE=InnoDB;
+
+CREATE TABLE `episode_transcript` (
+  `episode_id` int NOT NULL,
+  `format_version` tinyint NOT NULL,
+  `codec` varchar(10) NOT NULL,
+  `parts` int NOT NULL,
+  `raw_bytes` int NOT NULL,
+  `data` longblob NOT NULL,
+  PRIMARY KEY (`episode_id`)
+) ENGINE=InnoDB;
@@ -0,0 +1,2 @@
+-- keyset pagination for /api/search/ reads pages ordered by (air_date, id)
+ALTER TABLE `episode` ADD KEY `air_date_id` (`air_date`,`id`);
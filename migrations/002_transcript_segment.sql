@@ -0,0 +1,15 @@
+-- segment-level transcript index, populated by services/transcript_segment_indexer.py
+-- Hebrew stems are short: set innodb_ft_min_token_size=2 on the server before creating the FULLTEXT key
+CREATE TABLE `transcript_segment` (
+  `id` int NOT NULL AUTO_INCREMENT,
+  `episode_id` int NOT NULL,
+  `part` int NOT NULL,
+  `segment` int NOT NULL,
+  `start_offset` decimal(10,3) DEFAULT NULL,
+  `end_offset` decimal(10,3) DEFAULT NULL,
+  `text` text NOT NULL,
+  `normalized_text` text NOT NULL,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `episode_segment` (`episode_id`,`part`,`segment`),
+  FULLTEXT KEY `normalized_text_search` (`normalized_text`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
@@ -0,0 +1,5 @@
+-- row-level claiming for services/episode_worker_pool.py
+ALTER TABLE `episode`
+  ADD COLUMN `worker_id` varchar(150) DEFAULT NULL AFTER `err_msg`,
+  ADD COLUMN `lease_expires` datetime DEFAULT NULL AFTER `worker_id`,
+  ADD KEY `worker_id` (`worker_id`);
@@ -0,0 +1,5 @@
+-- pre-download duplicate detection, see precheck_remote_duplicate in services/episode_downloader.py
+ALTER TABLE `episode`
+  ADD COLUMN `remote_fingerprint` varchar(100) DEFAULT NULL AFTER `content_hash`,
+  ADD COLUMN `remote_etag` varchar(200) DEFAULT NULL AFTER `remote_fingerprint`,
+  ADD KEY `remote_fingerprint` (`remote_fingerprint`);
@@ -0,0 +1,2 @@
+-- duplicate lookups by content hash, see download_episode and find_duplicates_batch
+ALTER TABLE `episode` ADD KEY `content_hash` (`content_hash`);
@@ -0,0 +1,19 @@
+-- persisted Speech-to-Text operations, collected by services/transcription_poller.py
+CREATE TABLE `transcription_job` (
+  `id` int NOT NULL AUTO_INCREMENT,
+  `create_date` datetime DEFAULT CURRENT_TIMESTAMP,
+  `update_date` datetime DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  `episode_id` int NOT NULL,
+  `part` int NOT NULL,
+  `gcs_object` varchar(500) NOT NULL,
+  `audio_format` varchar(20) DEFAULT NULL,
+  `kept_intervals` json DEFAULT NULL,
+  `operation_name` varchar(500) NOT NULL,
+  `status` enum('submitted','done','error','stored') NOT NULL DEFAULT 'submitted',
+  `transcript` longtext,
+  `err_msg` varchar(500) DEFAULT NULL,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `episode_part` (`episode_id`,`part`),
+  KEY `operation_name` (`operation_name`),
+  KEY `status` (`status`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
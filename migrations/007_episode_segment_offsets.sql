@@ -0,0 +1,3 @@
+-- where each part in local_storage starts in the episode, see split_episode_file in services/episode_downloader.py
+ALTER TABLE `episode`
+  ADD COLUMN `segment_offsets` json DEFAULT NULL AFTER `local_storage`;
@@ -0,0 +1,19 @@
+-- near-duplicate detection by audio fingerprint, see services/audio_fingerprint.py
+CREATE TABLE `episode_fingerprint` (
+  `episode_id` int NOT NULL,
+  `frames` int NOT NULL,
+  `fingerprint` mediumblob NOT NULL,
+  PRIMARY KEY (`episode_id`)
+) ENGINE=InnoDB;
+
+CREATE TABLE `fingerprint_landmark` (
+  `hash` int unsigned NOT NULL,
+  `episode_id` int NOT NULL,
+  `position` int NOT NULL,
+  PRIMARY KEY (`episode_id`,`position`),
+  KEY `hash` (`hash`)
+) ENGINE=InnoDB;
+
+ALTER TABLE `episode`
+  ADD COLUMN `partial_duplicate_of` int DEFAULT NULL AFTER `duplicate_of`,
+  ADD COLUMN `duplicate_spans` json DEFAULT NULL AFTER `partial_duplicate_of`;
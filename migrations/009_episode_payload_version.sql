@@ -0,0 +1,3 @@
+-- bumped whenever the /api/episode/ payload changes, see services/episode_payload_cache.py
+ALTER TABLE `episode`
+  ADD COLUMN `payload_version` int NOT NULL DEFAULT 0 AFTER `transcripts`;
@@ -0,0 +1,4 @@
+-- highlights are saved in one transaction (store_highlights in server.py), which MyISAM ignores
+ALTER TABLE `highlights`
+  ENGINE=InnoDB,
+  ADD KEY `episode_id` (`episode_id`);
@@ -0,0 +1,16 @@
+-- compressed transcripts kept apart from the episode metadata, see services/transcript_store.py;
+-- fill it with python -m services.transcript_storage_migration [--clear-source]
+CREATE TABLE `episode_transcript` (
+  `episode_id` int NOT NULL,
+  `format_version` tinyint NOT NULL,
+  `codec` varchar(10) NOT NULL,
+  `parts` int NOT NULL,
+  `raw_bytes` int NOT NULL,
+  `data` longblob NOT NULL,
+  PRIMARY KEY (`episode_id`)
+) ENGINE=InnoDB;
+
+ALTER TABLE `episode`
+  ADD COLUMN `has_transcript` tinyint(1) NOT NULL DEFAULT 0 AFTER `drive_url`;
+
+UPDATE `episode` SET `has_transcript` = 1 WHERE `transcripts` IS NOT NULL;
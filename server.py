@@ -1,15 +1,28 @@
+import base64
+import bisect
 import json
 import math
 import os
 from typing import Optional, Literal
 from dotenv import load_dotenv
 
+import mysql.connector
 import uvicorn
-from fastapi import FastAPI
+from cachetools import TTLCache
+from fastapi import FastAPI, Request
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response
 from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool
 
-from utils import db
+from services.episode_payload_cache import choose_encoding, episode_payload_cache, etag_matches, payload_etag
+from services.local_search_index import SEARCH_BACKEND, local_index
+from services.search_snippets import compile_search_pattern, extract_hits
+from services.transcript_segment_indexer import segment_phrase_pattern, segment_search_expression
+from services.transcript_store import TRANSCRIPT_STORAGE, fill_transcripts
+from utils import async_db, db
+from utils.async_db import ClientDisconnected, QueryTimeout
 
 load_dotenv()
 
@@ -27,56 +40,262 @@ app.add_middleware(
 )
 
 
+@app.exception_handler(QueryTimeout)
+async def query_timeout_handler(request: Request, exc: QueryTimeout):
+    return JSONResponse({"error": "The query took too long, try a narrower search"}, status_code=504)
+
+
+@app.exception_handler(ClientDisconnected)
+async def client_disconnected_handler(request: Request, exc: ClientDisconnected):
+    # nobody is listening anymore, the status only shows up in the access log
+    return Response(status_code=499)
+
+
 class SearchQuery(BaseModel):
     type: Literal["contains", "regex", "boolean"]
     query: Optional[str] = None
     page: Optional[int] = 0
     page_size: Optional[int] = 20
+    # opaque token returned as "next_cursor" by a previous call; when set, "page" is ignored
+    cursor: Optional[str] = None
+    # "snippets" returns episode metadata plus the matching transcript segments instead of whole rows
+    response: Literal["full", "snippets"] = "full"
+
+
+SNIPPET_RESULT_COLUMNS = '''e.id, e.channel_id, e.page_url, e.file_url, e.air_date, e.runtime, e.transcripts, e.has_transcript,
+                            p.title'''
+SEGMENT_RESULT_COLUMNS = '''e.id AS episode_id, e.air_date, e.file_url, e.page_url, p.title,
+                            ts.part, ts.segment, ts.start_offset, ts.end_offset, ts.text'''
+SEARCH_COUNT_CACHE_TTL = int(os.getenv("SEARCH_COUNT_CACHE_TTL", 600))
+search_count_cache = TTLCache(maxsize=1024, ttl=SEARCH_COUNT_CACHE_TTL)
+# how long a looked-up episode.payload_version is trusted before asking MySQL again; highlight saves in this
+# process drop it right away, transcripts written by the pipeline show up after at most this long
+EPISODE_VERSION_TTL = int(os.getenv("EPISODE_VERSION_TTL", 5))
+episode_version_cache = TTLCache(maxsize=10000, ttl=EPISODE_VERSION_TTL)
+
+
+def encode_search_cursor(row: dict) -> str:
+    cursor = json.dumps([str(row["air_date"]), row["id"]])
+    return base64.urlsafe_b64encode(cursor.encode("utf8")).decode("ascii")
+
+
+def decode_search_cursor(cursor: str) -> Optional[dict]:
+    try:
+        air_date, episode_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return {"cursor_air_date": str(air_date), "cursor_id": int(episode_id)}
+    except (ValueError, TypeError):
+        return None
+
+
+async def count_search_results(search_type: str, search_term: str, base_query: str, request: Request,
+                              args: Optional[dict] = None) -> int:
+    cache_key = (search_type, search_term) + tuple(sorted((args or {}).items()))
+    if cache_key in search_count_cache:
+        return search_count_cache[cache_key]
+    res_count = await async_db.execute_query(
+        "SELECT COUNT(*) AS res_count FROM (" + base_query + ") AS results",
+        dict(args or {}, search=search_term),
+        "single_row",
+        request
+    )
+    if not res_count:
+        return 0
+    search_count_cache[cache_key] = res_count["res_count"]
+    return res_count["res_count"]
+
+
+DUPLICATE_LOOKUP_BATCH = 1000
+
+
+def drop_duplicate_matches(matches: list[tuple[str, int]]) -> list[tuple[str, int]]:
+    """Removes episodes marked duplicate_of after they were indexed, so they are neither listed nor counted."""
+    duplicates = set()
+    for i in range(0, len(matches), DUPLICATE_LOOKUP_BATCH):
+        ids = ", ".join(str(int(episode_id)) for _, episode_id in matches[i:i + DUPLICATE_LOOKUP_BATCH])
+        rows = db.execute_query(
+            "SELECT e.id FROM episode AS e WHERE e.id IN (" + ids + ") AND e.duplicate_of IS NOT NULL",
+            {}, "rows"
+        ) or []
+        duplicates.update(r["id"] for r in rows)
+    return [m for m in matches if m[1] not in duplicates]
 
 
 @app.post('/api/search/')
-async def fetch_search_results(search: SearchQuery):
+async def fetch_search_results(search: SearchQuery, request: Request):
     base_query_template = '''
-            SELECT e.*, p.title
+            SELECT {columns}
             FROM episode AS e 
             JOIN programme p ON e.programme_id = p.glz_id
             WHERE {search_condition}
             AND e.duplicate_of IS NULL
-            ORDER BY e.air_date
             '''
+    page_size = search.page_size
+    cursor_args = None
+    if search.cursor:
+        cursor_args = decode_search_cursor(search.cursor)
+        if cursor_args is None:
+            return {"error": "Invalid cursor"}
     search_term = search.query
     search_condition = "TRUE"
-    if search.type == "contains":
+    local_matches = None
+    if SEARCH_BACKEND == "local" and search.type != "regex":
+        # the local index resolves the matching ids, MySQL only serves the page rows by primary key
+        local_matches = await run_in_threadpool(local_index.search, search.type, search.query)
+        local_matches = await async_db.run(drop_duplicate_matches, local_matches)
+        start = search.page * page_size
+        if cursor_args:
+            start = bisect.bisect_right(local_matches, (cursor_args["cursor_air_date"], cursor_args["cursor_id"]))
+        page_ids = [episode_id for _, episode_id in local_matches[start:start + page_size + 1]]
+        search_condition = "e.id IN (" + ", ".join(str(int(i)) for i in page_ids) + ")" if page_ids else "FALSE"
+    elif TRANSCRIPT_STORAGE == "table":
+        # transcripts are stored compressed, their text is searched through the segment index
+        if search.type == "contains":
+            search_term = "%"+search_term+"%"
+            segment_condition = "ts.text LIKE %(search)s"
+        elif search.type == "regex":
+            segment_condition = "ts.text REGEXP %(search)s"
+        else:
+            search_term = segment_search_expression(search.type, search.query)
+            segment_condition = "MATCH (ts.normalized_text) AGAINST (%(search)s IN BOOLEAN MODE)"
+        search_condition = "EXISTS (SELECT 1 FROM transcript_segment AS ts WHERE ts.episode_id = e.id AND " + \
+                           segment_condition + ")"
+    elif search.type == "contains":
         search_term = "%"+search_term+"%"
         search_condition = "transcripts LIKE %(search)s"
-    if search.type == "regex":
+    elif search.type == "regex":
         search_condition = "transcripts REGEXP %(search)s"
-    if search.type == "boolean":
+    elif search.type == "boolean":
         search_condition = "MATCH (e.transcripts) AGAINST (%(search)s IN BOOLEAN MODE)"
     base_query = base_query_template.replace('{search_condition}', search_condition)
-    page_size = search.page_size
-    page_results_query = base_query + f" LIMIT {page_size} OFFSET %(offset)s"
-    results_count_query = "SELECT COUNT(*) AS res_count FROM (" + base_query + ") AS results"
-    results = db.execute_query(
-        page_results_query,
-        {"offset": search.page * page_size, "search": search_term},
-        "rows"
+    columns = "e.*, p.title"
+    if search.response == "snippets":
+        columns = SNIPPET_RESULT_COLUMNS
+    page_query = base_query.replace('{columns}', columns)
+    base_query = base_query.replace('{columns}', "e.id")
+    query_args = {"search": search_term}
+    if local_matches is not None:
+        page_results_query = page_query + " ORDER BY e.air_date, e.id"
+    elif cursor_args:
+        query_args.update(cursor_args)
+        # keyset read on (air_date, id): continues right after the last row of the previous page
+        page_results_query = page_query + '''
+            AND (e.air_date, e.id) > (%(cursor_air_date)s, %(cursor_id)s)
+            ORDER BY e.air_date, e.id
+            ''' + f" LIMIT {page_size + 1}"
+    else:
+        query_args["offset"] = search.page * page_size
+        page_results_query = page_query + " ORDER BY e.air_date, e.id" + f" LIMIT {page_size + 1} OFFSET %(offset)s"
+    results = await async_db.execute_query(page_results_query, query_args, "rows", request) or []
+    next_cursor = None
+    if len(results) > page_size:
+        results = results[:page_size]
+        next_cursor = encode_search_cursor(results[-1])
+    await async_db.run(fill_transcripts, results, search.response == "full")
+    if search.response == "snippets":
+        pattern = compile_search_pattern(search.type, search.query)
+        for r in results:
+            r["hits"] = await run_in_threadpool(extract_hits, r.pop("transcripts"), pattern)
+    if local_matches is not None:
+        results_count = len(local_matches)
+    else:
+        results_count = await count_search_results(search.type, search_term, base_query, request)
+    return {
+        "results": results,
+        "count": math.ceil(results_count / page_size),
+        "next_cursor": next_cursor,
+    }
+
+
+@app.post('/api/search/segments/')
+async def fetch_segment_search_results(search: SearchQuery, request: Request):
+    search_expression = segment_search_expression(search.type, search.query)
+    if search_expression is None:
+        return {"error": "Unsupported segment search"}
+    phrase_args = {}
+    phrase_condition = ""
+    phrase_pattern = segment_phrase_pattern(search.type, search.query)
+    if phrase_pattern is not None:
+        phrase_args["phrase"] = phrase_pattern
+        phrase_condition = "AND ts.text LIKE %(phrase)s"
+    base_query_template = '''
+            SELECT {columns}
+            FROM transcript_segment AS ts
+            JOIN episode AS e ON ts.episode_id = e.id
+            JOIN programme p ON e.programme_id = p.glz_id
+            WHERE {match_condition}
+            {phrase_condition}
+            AND e.duplicate_of IS NULL
+            '''.replace('{phrase_condition}', phrase_condition)
+    base_query = base_query_template.replace('{match_condition}', "MATCH (ts.normalized_text) AGAINST (%(search)s IN BOOLEAN MODE)")
+    results_count = await count_search_results(
+        "segments", search_expression, base_query.replace('{columns}', "ts.id"), request, phrase_args
     )
-    results_count_query = db.execute_query(
-        results_count_query,
-        {"search": search_term},
-        "single_row"
-    )["res_count"] / page_size
-    results_count_query = math.ceil(results_count_query)
+    if not results_count and phrase_pattern is not None:
+        # the full-text index only matches from the start of a word, a contains search for the middle of a word
+        # falls back to scanning the segment text with LIKE alone
+        base_query = base_query_template.replace('{match_condition}', "TRUE")
+        results_count = await count_search_results(
+            "segments-substring", phrase_pattern, base_query.replace('{columns}', "ts.id"), request, phrase_args
+        )
+    page_size = search.page_size
+    results = []
+    if results_count:
+        results = await async_db.execute_query(
+            base_query.replace('{columns}', SEGMENT_RESULT_COLUMNS) +
+            " ORDER BY e.air_date, e.id, ts.part, ts.segment" + f" LIMIT {page_size} OFFSET %(offset)s",
+            dict(phrase_args, search=search_expression, offset=search.page * page_size),
+            "rows",
+            request
+        ) or []
     return {
         "results": results,
-        "count": results_count_query,
+        "count": math.ceil(results_count / page_size),
     }
 
 
+async def fetch_episode_version(episode_id: int, request: Request) -> Optional[int]:
+    if episode_id in episode_version_cache:
+        return episode_version_cache[episode_id]
+    row = await async_db.execute_query(
+        '''SELECT e.payload_version FROM episode AS e WHERE e.id = %(episode_id)s AND e.duplicate_of IS NULL''',
+        {"episode_id": episode_id},
+        "single_row",
+        request
+    )
+    if not row:
+        return None
+    episode_version_cache[episode_id] = row["payload_version"]
+    return row["payload_version"]
+
+
+def episode_cache_headers(etag: str) -> dict:
+    # browsers keep the payload but revalidate it with If-None-Match on every load
+    return {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+
+
+def episode_response(payload, request: Request) -> Response:
+    headers = episode_cache_headers(payload.etag)
+    if etag_matches(request.headers.get("if-none-match"), payload.etag):
+        return Response(status_code=304, headers=headers)
+    encoding = choose_encoding(request.headers.get("accept-encoding"), payload)
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(payload.body(encoding), media_type="application/json", headers=headers)
+
+
 @app.get('/api/episode/{episode_id}')
-async def fetch_episode(episode_id: int):
-    episode = db.execute_query(
+async def fetch_episode(episode_id: int, request: Request):
+    # the payload only changes with payload_version, which store_transcripts and save_highlights bump
+    version = await fetch_episode_version(episode_id, request)
+    if version is None:
+        return {"error": "Episode not found"}
+    etag = payload_etag(episode_id, version)
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=episode_cache_headers(etag))
+    payload = episode_payload_cache.get(episode_id, version)
+    if payload is not None:
+        return episode_response(payload, request)
+    episode = await async_db.execute_query(
         '''
                     SELECT e.*, p.title
                     FROM episode AS e 
@@ -86,25 +305,43 @@ async def fetch_episode(episode_id: int):
                     ORDER BY e.air_date
                     ''',
         {"episode_id": episode_id},
-        "single_row"
+        "single_row",
+        request
     )
     if episode is None:
         return {"error": "Episode not found"}
-    highlights = db.execute_query(
+    await async_db.run(fill_transcripts, [episode])
+    highlights = await async_db.execute_query(
         '''
                     SELECT h.*
                     FROM highlights AS h 
                     WHERE h.episode_id = %(episode_id)s
                     ''',
         {"episode_id": episode_id},
-        "rows"
-    )
+        "rows",
+        request
+    ) or []
     for h in highlights:
         h["range"] = json.loads(h["range"])
-    return {
+    content = jsonable_encoder({
         "episode": episode,
         "highlights": highlights,
-    }
+    })
+    payload = await run_in_threadpool(episode_payload_cache.put, episode_id, episode["payload_version"], content)
+    return episode_response(payload, request)
+
+
+async def invalidate_episode_payloads(episode_ids: set[int]):
+    args = {"id_" + str(i): episode_id for i, episode_id in enumerate(episode_ids)}
+    await async_db.execute_query(
+        "UPDATE episode SET payload_version = payload_version + 1 WHERE id IN (" +
+        ", ".join("%(" + k + ")s" for k in args) + ")",
+        args,
+        "none"
+    )
+    for episode_id in episode_ids:
+        episode_version_cache.pop(episode_id, None)
+        episode_payload_cache.invalidate(episode_id)
 
 
 class Highlight(BaseModel):
@@ -123,62 +360,90 @@ class HighlightsSave(BaseModel):
     to_delete: list[int]
 
 
-@app.post('/api/highlights/')
-async def save_highlights(save: HighlightsSave):
-    highlights = save.highlights
-    episode_id = save.episode_id
-    to_delete = save.to_delete
-    for h in highlights:
-        if h.id is None:
-            db.execute_query(
-                '''INSERT INTO highlights (`episode_id`, `range`, `original_text`, `fixed_text`, `speaker_name`, `title`)
-                VALUES (%(episode_id)s, %(range)s, %(original_text)s, %(fixed_text)s, %(speaker_name)s, %(title)s)''',
-                {
-                    "episode_id": h.episode_id,
-                    "range": json.dumps(h.range),
-                    "original_text": h.original_text,
-                    "fixed_text": h.fixed_text,
-                    "speaker_name": h.speaker_name,
-                    "title": h.title
-                },
-                "id"
+HIGHLIGHT_COLUMNS = ["episode_id", "range", "original_text", "fixed_text", "speaker_name", "title"]
+
+
+def highlight_row(h: Highlight) -> dict:
+    return {
+        "id": h.id,
+        "episode_id": h.episode_id,
+        "range": json.dumps(h.range),
+        "original_text": h.original_text,
+        "fixed_text": h.fixed_text,
+        "speaker_name": h.speaker_name,
+        "title": h.title
+    }
+
+
+def store_highlights(highlights: list[Highlight], to_delete: list[int]) -> tuple[list[dict], set[int]]:
+    """Saves all highlights and deletes in one transaction.
+
+    Returns the saved rows with their ids and the ids of every episode whose highlights changed. An edit of a
+    highlight someone else already deleted is dropped rather than bringing it back.
+    """
+    rows = [highlight_row(h) for h in highlights]
+    new_rows = [r for r in rows if r["id"] is None]
+    existing_rows = [r for r in rows if r["id"] is not None]
+    touched_ids = [r["id"] for r in existing_rows] + list(to_delete)
+    episode_ids = {r["episode_id"] for r in rows}
+    with db.transaction() as cursor:
+        current = {}
+        if touched_ids:
+            args = {"id_" + str(i): h for i, h in enumerate(touched_ids)}
+            cursor.execute(
+                "SELECT id, episode_id FROM highlights WHERE id IN (" + ", ".join("%(" + k + ")s" for k in args) +
+                ") FOR UPDATE",
+                args
             )
-        else:
-            db.execute_query(
-                '''UPDATE highlights SET
-                 `episode_id` = %(episode_id)s, 
-                 `range` = %(range)s,
-                 `original_text` = %(original_text)s, 
-                 `fixed_text` = %(fixed_text)s, 
-                 `speaker_name` = %(speaker_name)s,
-                 `title` = %(title)s
-                WHERE `id` = %(id)s''',
-                {
-                    "id": h.id,
-                    "episode_id": h.episode_id,
-                    "range": json.dumps(h.range),
-                    "original_text": h.original_text,
-                    "fixed_text": h.fixed_text,
-                    "speaker_name": h.speaker_name,
-                    "title": h.title
-                },
-                "id"
+            current = {row[0]: row[1] for row in cursor.fetchall()}
+            episode_ids.update(e for e in current.values() if e is not None)
+        existing_rows = [r for r in existing_rows if r["id"] in current]
+        if existing_rows:
+            # updates through a join, so rows that are gone match nothing instead of being inserted again
+            columns = ["id"] + HIGHLIGHT_COLUMNS
+            args = {}
+            selects = []
+            for i, row in enumerate(existing_rows):
+                for c in columns:
+                    args[c + "_" + str(i)] = row[c]
+                selects.append("SELECT " + ", ".join("%(" + c + "_" + str(i) + ")s AS `" + c + "`" for c in columns))
+            cursor.execute(
+                "UPDATE highlights AS h JOIN (" + " UNION ALL ".join(selects) + ") AS v ON v.`id` = h.`id` SET " +
+                ", ".join("h.`" + c + "` = v.`" + c + "`" for c in HIGHLIGHT_COLUMNS),
+                args
             )
-    for h in to_delete:
-        db.execute_query(
-            "DELETE FROM highlights WHERE id = %(id)s",
-            {"id": h},
-            "none"
-        )
-    results = db.execute_query(
-        "SELECT * FROM highlights WHERE episode_id = %(episode_id)s",
-        {"episode_id": episode_id},
-        "rows"
-    )
-    for r in results:
+        # one INSERT per new row, with innodb_autoinc_lock_mode=2 a multi-row INSERT may get non-consecutive ids
+        for r in new_rows:
+            cursor.execute(
+                "INSERT INTO highlights (" + ", ".join("`" + c + "`" for c in HIGHLIGHT_COLUMNS) + ") VALUES (" +
+                ", ".join("%(" + c + ")s" for c in HIGHLIGHT_COLUMNS) + ")",
+                r
+            )
+            r["id"] = cursor.lastrowid
+        if to_delete:
+            args = {"id_" + str(i): h for i, h in enumerate(to_delete)}
+            cursor.execute(
+                "DELETE FROM highlights WHERE id IN (" + ", ".join("%(" + k + ")s" for k in args) + ")",
+                args
+            )
+    kept = {id(r) for r in existing_rows + new_rows}
+    saved = [r for r in rows if id(r) in kept]
+    for r in saved:
         r["range"] = json.loads(r["range"])
+    return saved, episode_ids
+
+
+@app.post('/api/highlights/')
+async def save_highlights(save: HighlightsSave):
+    # writes are not tied to the request, so a client that leaves mid-save does not cancel it
+    try:
+        rows, episode_ids = await async_db.run(store_highlights, save.highlights, save.to_delete)
+    except mysql.connector.Error as err:
+        print(err)
+        return {"error": "Saving the highlights failed, nothing was saved"}
+    await invalidate_episode_payloads({save.episode_id} | episode_ids)
     return {
-        "saved_quotes": results,
+        "saved_quotes": [r for r in rows if r["episode_id"] == save.episode_id],
     }
 
 
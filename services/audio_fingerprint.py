@@ -0,0 +1,206 @@
+import json
+import subprocess
+import zlib
+from array import array
+from collections import Counter
+from pathlib import Path
+from typing import Optional
+
+from root_anchor import ROOT_DIR
+from utils import db
+
+# Chromaprint emits one 32 bit sub-fingerprint every 4096/3 samples at 11025Hz
+FRAME_SECONDS = 0.1238
+# every LANDMARK_STRIDE-th sub-fingerprint goes into the lookup index, the full fingerprint is kept separately
+LANDMARK_STRIDE = 4
+LANDMARK_LOOKUP_BATCH = 1000
+# aligned sub-fingerprints differing in at most this many bits count as the same audio
+MAX_BIT_ERRORS = 8
+# an alignment needs this many landmark hits before it is verified against the full fingerprint
+MIN_ALIGNMENT_VOTES = 20
+MAX_ALIGNMENTS_PER_CANDIDATE = 8
+# sub-fingerprints this common (silence, tones, station jingles) say nothing about alignment and would multiply
+# into positions x hits votes: skipped when repeated more often within the episode or across the landmarks
+MAX_HASH_POSITIONS = 16
+MAX_HASH_HITS = 64
+MAX_CANDIDATES = 5
+# matching frames closer than this are joined into one span, spans shorter than MIN_SPAN_SECONDS are ignored
+SPAN_GAP_SECONDS = 5
+MIN_SPAN_SECONDS = 30
+# share of the episode covered by an earlier one to call it a duplicate, or to transcribe only the rest
+DUPLICATE_COVERAGE = 0.9
+PARTIAL_DUPLICATE_COVERAGE = 0.2
+
+
+def fingerprint_file(file_path: Path) -> list[int]:
+    result = subprocess.run(
+        ["fpcalc", "-raw", "-json", "-length", "0", str(file_path)],
+        check=True, capture_output=True, text=True
+    )
+    return [v & 0xFFFFFFFF for v in json.loads(result.stdout)["fingerprint"]]
+
+
+def fingerprint_files(file_paths: list[Path]) -> list[int]:
+    """Fingerprint of consecutive parts of one episode, as if they were one file."""
+    fingerprint = []
+    for file_path in file_paths:
+        fingerprint.extend(fingerprint_file(file_path))
+    return fingerprint
+
+
+def store_fingerprint(episode_id: int, fingerprint: list[int]):
+    db.execute_query(
+        '''REPLACE INTO episode_fingerprint (`episode_id`, `frames`, `fingerprint`)
+        VALUES (%(episode_id)s, %(frames)s, %(fingerprint)s)''',
+        {"episode_id": episode_id, "frames": len(fingerprint), "fingerprint": zlib.compress(array('I', fingerprint).tobytes())},
+        "none"
+    )
+    db.execute_query(
+        '''DELETE FROM fingerprint_landmark WHERE episode_id = %(episode_id)s''',
+        {"episode_id": episode_id}, "none"
+    )
+    db.execute_many(
+        '''INSERT INTO fingerprint_landmark (`hash`, `episode_id`, `position`)
+        VALUES (%(hash)s, %(episode_id)s, %(position)s)''',
+        [{"hash": fingerprint[p], "episode_id": episode_id, "position": p}
+         for p in range(0, len(fingerprint), LANDMARK_STRIDE)]
+    )
+
+
+def load_fingerprint(episode_id: int) -> list[int]:
+    row = db.execute_query(
+        '''SELECT f.fingerprint FROM episode_fingerprint AS f WHERE f.episode_id = %(episode_id)s''',
+        {"episode_id": episode_id}, "single_row"
+    )
+    if not row:
+        return []
+    fingerprint = array('I')
+    fingerprint.frombytes(zlib.decompress(row["fingerprint"]))
+    return fingerprint.tolist()
+
+
+def alignment_votes(episode_id: int, fingerprint: list[int]) -> Counter:
+    """Counts landmark hits per (earlier episode, frame shift), only against episodes that are not duplicates,
+    leaving out sub-fingerprints too common to place an alignment."""
+    positions = {}
+    for p, value in enumerate(fingerprint):
+        positions.setdefault(value, []).append(p)
+    hashes = [h for h, p in positions.items() if len(p) <= MAX_HASH_POSITIONS]
+    votes = Counter()
+    for i in range(0, len(hashes), LANDMARK_LOOKUP_BATCH):
+        args = {"h_" + str(j): h for j, h in enumerate(hashes[i:i + LANDMARK_LOOKUP_BATCH])}
+        # drop the hashes common across the archive first, so their hits are never fetched at all
+        common = db.execute_query(
+            '''SELECT l.hash FROM fingerprint_landmark AS l
+            WHERE l.hash IN (''' + ", ".join("%(" + k + ")s" for k in args) + ''')
+            GROUP BY l.hash
+            HAVING COUNT(*) > %(max_hits)s
+            ''',
+            dict(args, max_hits=MAX_HASH_HITS), "rows"
+        ) or []
+        common_hashes = {r["hash"] for r in common}
+        args = {k: h for k, h in args.items() if h not in common_hashes}
+        if not args:
+            continue
+        args["episode_id"] = episode_id
+        hits = db.execute_query(
+            '''SELECT l.hash, l.episode_id, l.position
+            FROM fingerprint_landmark AS l
+            JOIN episode AS e ON e.id = l.episode_id
+            WHERE l.hash IN (''' + ", ".join("%(" + k + ")s" for k in args if k.startswith("h_")) + ''')
+             AND l.episode_id <> %(episode_id)s
+             AND e.duplicate_of IS NULL
+            ''',
+            args, "rows"
+        ) or []
+        for hit in hits:
+            for p in positions[hit["hash"]]:
+                votes[(hit["episode_id"], hit["position"] - p)] += 1
+    return votes
+
+
+def matching_spans(fingerprint: list[int], other: list[int], shifts: list[int]) -> list[tuple[float, float]]:
+    """Spans of the fingerprint, in seconds, that match the other fingerprint at any of the frame shifts."""
+    matched = bytearray(len(fingerprint))
+    for shift in shifts:
+        for p in range(max(0, -shift), min(len(fingerprint), len(other) - shift)):
+            if (fingerprint[p] ^ other[p + shift]).bit_count() <= MAX_BIT_ERRORS:
+                matched[p] = 1
+    spans = []
+    max_gap = int(SPAN_GAP_SECONDS / FRAME_SECONDS)
+    start = end = None
+    for p, is_match in enumerate(matched):
+        if not is_match:
+            continue
+        if start is not None and p - end > max_gap:
+            spans.append((start, end))
+            start = None
+        if start is None:
+            start = p
+        end = p
+    if start is not None:
+        spans.append((start, end))
+    return [
+        (start * FRAME_SECONDS, (end + 1) * FRAME_SECONDS) for start, end in spans
+        if (end + 1 - start) * FRAME_SECONDS >= MIN_SPAN_SECONDS
+    ]
+
+
+def find_overlap(episode_id: int, fingerprint: list[int]) -> Optional[dict]:
+    """Finds the earlier episode sharing the most audio with this one.
+
+    Returns {episode_id, coverage, spans}, with the shared spans in seconds of this episode, or None when no
+    episode shares at least one span of MIN_SPAN_SECONDS.
+    """
+    if not fingerprint:
+        return None
+    votes = alignment_votes(episode_id, fingerprint)
+    shifts_by_candidate = {}
+    for (candidate, shift), count in votes.most_common():
+        if count < MIN_ALIGNMENT_VOTES:
+            break
+        shifts = shifts_by_candidate.setdefault(candidate, [])
+        if len(shifts) < MAX_ALIGNMENTS_PER_CANDIDATE:
+            shifts.append(shift)
+    best = None
+    for candidate in list(shifts_by_candidate)[:MAX_CANDIDATES]:
+        spans = matching_spans(fingerprint, load_fingerprint(candidate), shifts_by_candidate[candidate])
+        coverage = sum(end - start for start, end in spans) / (len(fingerprint) * FRAME_SECONDS)
+        if spans and (best is None or coverage > best["coverage"]):
+            best = {"episode_id": candidate, "coverage": coverage, "spans": spans}
+    return best
+
+
+def backfill_fingerprints():
+    """Fingerprints processed episodes whose parts are still on disk, so later reruns can be matched to them."""
+    last_id = 0
+    fingerprinted = 0
+    while True:
+        episodes = db.execute_query(
+            '''SELECT e.id, e.local_storage
+            FROM episode AS e
+            LEFT JOIN episode_fingerprint AS f ON f.episode_id = e.id
+            WHERE e.id > %(last_id)s
+             AND e.local_storage IS NOT NULL
+             AND e.duplicate_of IS NULL
+             AND f.episode_id IS NULL
+            ORDER BY e.id
+            LIMIT 100
+            ''',
+            {"last_id": last_id}, "rows"
+        )
+        if not episodes:
+            break
+        last_id = episodes[-1]["id"]
+        for e in episodes:
+            file_paths = [ROOT_DIR / "dir" / s for s in json.loads(e["local_storage"])]
+            if not all(p.exists() for p in file_paths):
+                continue
+            store_fingerprint(e["id"], fingerprint_files(file_paths))
+            fingerprinted += 1
+        print("fingerprinted " + str(fingerprinted) + " episodes")
+    return fingerprinted
+
+
+if __name__ == "__main__":
+    backfill_fingerprints()
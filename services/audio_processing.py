@@ -0,0 +1,277 @@
+import os
+import re
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional
+
+try:
+    import numpy
+    from faster_whisper.vad import VadOptions, get_speech_timestamps
+except ImportError:
+    get_speech_timestamps = None
+
+# "copy" cuts the source on frame boundaries without decoding, "reencode" also converts each part to 32k,
+# "vad" cuts at pauses in speech and leaves out long stretches without speech
+SPLIT_MODE = os.getenv("SPLIT_MODE", "copy")
+SPLIT_WORKERS = int(os.getenv("SPLIT_WORKERS", os.cpu_count() or 2))
+SPLIT_BITRATE = "32k"
+
+
+def probe_duration(file_path: Path) -> float:
+    result = subprocess.run([
+        "ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "default=noprint_wrappers=1:nokey=1",
+        str(file_path)
+    ], check=True, capture_output=True, text=True)
+    return float(result.stdout.strip())
+
+
+def segment_file_names(file_name: str, file_ext: str, count: int) -> list[str]:
+    return [file_name + "_p" + str(i) + "." + file_ext for i in range(1, count + 1)]
+
+
+def list_segment_files(output_dir: Path, file_name: str, file_ext: str) -> list[str]:
+    """Names of the consecutive <file_name>_pN parts a segment muxer wrote, starting at _p1."""
+    segments = []
+    while (output_dir / (file_name + "_p" + str(len(segments) + 1) + "." + file_ext)).exists():
+        segments.append(file_name + "_p" + str(len(segments) + 1) + "." + file_ext)
+    return segments
+
+
+def split_stream_copy(file_path: Path, file_name: str, file_ext: str, segment_length: int) -> list[str]:
+    """Cuts the file into segment_length parts with ffmpeg's segment muxer, copying the compressed frames."""
+    output_dir = file_path.parent
+    subprocess.run([
+        "ffmpeg", "-y", "-v", "error", "-i", str(file_path), "-map", "0:a", "-c", "copy",
+        "-f", "segment", "-segment_time", str(segment_length), "-segment_start_number", "1",
+        "-reset_timestamps", "1", str(output_dir / (file_name + "_p%d." + file_ext))
+    ], check=True)
+    return list_segment_files(output_dir, file_name, file_ext)
+
+
+def encode_segment(file_path: Path, output_path: Path, start: int, length: int, file_ext: str):
+    subprocess.run([
+        "ffmpeg", "-y", "-v", "error", "-ss", str(start), "-t", str(length), "-i", str(file_path),
+        "-vn", "-ab", SPLIT_BITRATE, "-f", file_ext, str(output_path)
+    ], check=True)
+
+
+def split_reencode(file_path: Path, file_name: str, file_ext: str, segment_length: int) -> list[str]:
+    """Re-encodes every part in its own ffmpeg process, all parts in parallel; ffmpeg seeks to the part's
+    start, so no process decodes more than its own part."""
+    duration = probe_duration(file_path)
+    starts = list(range(0, max(int(duration), 1), segment_length))
+    segments = segment_file_names(file_name, file_ext, len(starts))
+    with ThreadPoolExecutor(max_workers=SPLIT_WORKERS) as executor:
+        futures = [
+            executor.submit(encode_segment, file_path, file_path.parent / s, start, segment_length, file_ext)
+            for start, s in zip(starts, segments)
+        ]
+        for f in futures:
+            f.result()
+    return segments
+
+
+def split_audio(file_path: Path, file_name: str, file_ext: str, segment_length: int,
+                exclude: Optional[list[tuple[float, float]]] = None) -> tuple[list[str], list[float]]:
+    """Splits the file into parts of at most segment_length seconds, leaving out the excluded spans; returns
+    the part names and the offset in the original file each part starts at."""
+    if SPLIT_MODE == "vad" or exclude:
+        duration = probe_duration(file_path)
+        spans = detect_speech(file_path, duration) if SPLIT_MODE == "vad" else [(0.0, duration)]
+        return split_spans(file_path, file_name, file_ext, segment_length, subtract_spans(spans, exclude or []), duration)
+    if SPLIT_MODE == "reencode":
+        segments = split_reencode(file_path, file_name, file_ext, segment_length)
+    else:
+        segments = split_stream_copy(file_path, file_name, file_ext, segment_length)
+    return segments, [float(i * segment_length) for i in range(len(segments))]
+
+
+# "mp3" uploads the split parts as they are; "flac" or "opus" first converts them to 16kHz mono with silence cut
+TRANSCRIPTION_FORMAT = os.getenv("TRANSCRIPTION_FORMAT", "mp3")
+TRANSCRIPTION_SAMPLE_RATE = 16000
+SILENCE_THRESHOLD = "-40dB"
+MIN_SILENCE_SECONDS = 2.0
+# speech kept on each side of a removed silence, so words at the edges are not clipped
+SILENCE_PADDING_SECONDS = 0.25
+TRANSCRIPTION_CODEC_ARGS = {
+    "flac": ["-c:a", "flac", "-f", "flac"],
+    "opus": ["-c:a", "libopus", "-b:a", "24k", "-application", "voip", "-f", "ogg"],
+}
+TRANSCRIPTION_FILE_EXT = {"flac": "flac", "opus": "ogg"}
+SILENCE_START = re.compile(r'silence_start: (-?[\d.]+)')
+SILENCE_END = re.compile(r'silence_end: ([\d.]+)')
+
+
+def detect_silences(file_path: Path, min_silence_seconds: float = MIN_SILENCE_SECONDS) -> list[tuple[float, float]]:
+    result = subprocess.run([
+        "ffmpeg", "-v", "info", "-i", str(file_path),
+        "-af", "silencedetect=noise=" + SILENCE_THRESHOLD + ":d=" + str(min_silence_seconds), "-f", "null", "-"
+    ], check=True, capture_output=True, text=True)
+    starts = [max(float(s), 0.0) for s in SILENCE_START.findall(result.stderr)]
+    ends = [float(e) for e in SILENCE_END.findall(result.stderr)]
+    return list(zip(starts, ends + [float("inf")] * (len(starts) - len(ends))))
+
+
+def kept_intervals(silences: list[tuple[float, float]], duration: float) -> list[tuple[float, float]]:
+    """Complement of the silences, each silence shrunk by SILENCE_PADDING_SECONDS on both sides."""
+    kept = []
+    position = 0.0
+    for start, end in silences:
+        cut_start = start + SILENCE_PADDING_SECONDS if start > 0 else 0.0
+        cut_end = min(end, duration) - SILENCE_PADDING_SECONDS if end < duration else duration
+        if cut_end <= cut_start:
+            continue
+        if cut_start > position:
+            kept.append((position, cut_start))
+        position = cut_end
+    if position < duration:
+        kept.append((position, duration))
+    return kept
+
+
+def map_offset(offset: float, kept: Optional[list[tuple[float, float]]]) -> float:
+    """Maps a time in the silence-trimmed audio back to the same moment in the original audio."""
+    if not kept:
+        return offset
+    trimmed_position = 0.0
+    for start, end in kept:
+        if offset <= trimmed_position + (end - start):
+            return start + offset - trimmed_position
+        trimmed_position += end - start
+    return kept[-1][1]
+
+
+def prepare_for_transcription(file_path: Path, audio_format: str = TRANSCRIPTION_FORMAT) -> dict:
+    """Converts a part to compact 16kHz mono audio with long silences removed.
+
+    Returns the prepared file name, its format and the kept intervals of the original timeline (for map_offset),
+    along with the byte and second counts before and after.
+    """
+    if audio_format not in TRANSCRIPTION_CODEC_ARGS:
+        size = file_path.stat().st_size
+        return {"file": file_path.name, "format": None, "kept": None, "original_bytes": size, "prepared_bytes": size}
+    duration = probe_duration(file_path)
+    kept = kept_intervals(detect_silences(file_path), duration)
+    select = "+".join("between(t," + f"{start:.3f}" + "," + f"{end:.3f}" + ")" for start, end in kept) or "0"
+    output_path = file_path.with_name(file_path.stem + "_stt." + TRANSCRIPTION_FILE_EXT[audio_format])
+    subprocess.run([
+        "ffmpeg", "-y", "-v", "error", "-i", str(file_path),
+        "-af", "aselect='" + select + "',asetpts=N/SR/TB", "-ac", "1", "-ar", str(TRANSCRIPTION_SAMPLE_RATE)
+    ] + TRANSCRIPTION_CODEC_ARGS[audio_format] + [str(output_path)], check=True)
+    return {
+        "file": output_path.name,
+        "format": audio_format,
+        "kept": kept,
+        "original_bytes": file_path.stat().st_size,
+        "prepared_bytes": output_path.stat().st_size,
+        "original_seconds": duration,
+        "prepared_seconds": sum(end - start for start, end in kept),
+    }
+
+
+# stretches without speech at least this long (music, jingles, dead air) are left out of the parts
+VAD_MIN_GAP_SECONDS = float(os.getenv("VAD_MIN_GAP_SECONDS", 10))
+# shortest pause a part may be cut at
+VAD_MIN_PAUSE_SECONDS = 0.5
+# speech kept around every detected span, so the VAD does not clip the first and last words
+VAD_PADDING_SECONDS = 0.5
+# audio is decoded for the VAD this many seconds at a time, to keep memory flat for multi-hour episodes
+VAD_WINDOW_SECONDS = 600
+
+
+def detect_speech_windowed(file_path: Path, duration: float) -> list[tuple[float, float]]:
+    """Speech spans found by the Silero VAD bundled with faster-whisper, decoded window by window."""
+    spans = []
+    options = VadOptions(min_silence_duration_ms=int(VAD_MIN_PAUSE_SECONDS * 1000))
+    for window_start in range(0, max(int(duration), 1), VAD_WINDOW_SECONDS):
+        pcm = subprocess.run([
+            "ffmpeg", "-v", "error", "-ss", str(window_start), "-t", str(VAD_WINDOW_SECONDS), "-i", str(file_path),
+            "-ac", "1", "-ar", str(TRANSCRIPTION_SAMPLE_RATE), "-f", "s16le", "-"
+        ], check=True, capture_output=True).stdout
+        audio = numpy.frombuffer(pcm, numpy.int16).astype(numpy.float32) / 32768.0
+        for t in get_speech_timestamps(audio, options):
+            start = window_start + t["start"] / TRANSCRIPTION_SAMPLE_RATE
+            end = window_start + t["end"] / TRANSCRIPTION_SAMPLE_RATE
+            # a span cut by the window edge continues in the next window
+            if spans and start - spans[-1][1] < VAD_MIN_PAUSE_SECONDS:
+                spans[-1] = (spans[-1][0], end)
+            else:
+                spans.append((start, end))
+    return spans
+
+
+def detect_speech(file_path: Path, duration: float) -> list[tuple[float, float]]:
+    if get_speech_timestamps is not None:
+        return detect_speech_windowed(file_path, duration)
+    # without the VAD only silence can be told apart from speech, music is kept
+    spans = []
+    position = 0.0
+    for start, end in detect_silences(file_path, VAD_MIN_PAUSE_SECONDS):
+        if start > position:
+            spans.append((position, start))
+        position = min(end, duration)
+    if position < duration:
+        spans.append((position, duration))
+    return spans
+
+
+def speech_chunks(speech: list[tuple[float, float]], duration: float, target_length: int) -> list[tuple[float, float]]:
+    """Groups speech spans into chunks of at most target_length seconds, each chunk ending at the last pause
+    before the limit; a gap of VAD_MIN_GAP_SECONDS or more always ends a chunk and is left out."""
+    chunks = []
+    chunk_start = chunk_end = None
+    for start, end in speech:
+        start = max(start - VAD_PADDING_SECONDS, chunk_end or 0.0, 0.0)
+        end = min(end + VAD_PADDING_SECONDS, duration)
+        if chunk_start is not None and (start - chunk_end >= VAD_MIN_GAP_SECONDS or end - chunk_start > target_length):
+            chunks.append((chunk_start, chunk_end))
+            chunk_start = None
+        if chunk_start is None:
+            chunk_start = start
+            # a single span longer than a chunk is cut at the limit
+            while end - chunk_start > target_length:
+                chunks.append((chunk_start, chunk_start + target_length))
+                chunk_start += target_length
+        chunk_end = end
+    if chunk_start is not None and chunk_end > chunk_start:
+        chunks.append((chunk_start, chunk_end))
+    return chunks
+
+
+def extract_chunk(file_path: Path, output_path: Path, start: float, end: float):
+    subprocess.run([
+        "ffmpeg", "-y", "-v", "error", "-ss", f"{start:.3f}", "-t", f"{end - start:.3f}", "-i", str(file_path),
+        "-map", "0:a", "-c", "copy", str(output_path)
+    ], check=True)
+
+
+def subtract_spans(spans: list[tuple[float, float]], exclude: list[tuple[float, float]]) -> list[tuple[float, float]]:
+    remaining = []
+    for start, end in spans:
+        for exclude_start, exclude_end in sorted(exclude):
+            if exclude_end <= start or exclude_start >= end:
+                continue
+            if exclude_start > start:
+                remaining.append((start, exclude_start))
+            start = max(start, exclude_end)
+        if end > start:
+            remaining.append((start, end))
+    return remaining
+
+
+def split_spans(file_path: Path, file_name: str, file_ext: str, target_length: int,
+                spans: list[tuple[float, float]], duration: float) -> tuple[list[str], list[float]]:
+    """Cuts the spans to keep out of the file as parts of at most target_length seconds."""
+    chunks = speech_chunks(spans, duration, target_length)
+    segments = segment_file_names(file_name, file_ext, len(chunks))
+    with ThreadPoolExecutor(max_workers=SPLIT_WORKERS) as executor:
+        futures = [
+            executor.submit(extract_chunk, file_path, file_path.parent / s, start, end)
+            for (start, end), s in zip(chunks, segments)
+        ]
+        for f in futures:
+            f.result()
+    speech_seconds = sum(end - start for start, end in chunks)
+    print(f"kept {speech_seconds:.0f}s out of {duration:.0f}s in {len(chunks)} parts")
+    return segments, [start for start, _ in chunks]
@@ -3,25 +3,34 @@ import urllib
 import urllib.request
 import os
 import requests
+import requests.adapters
 import subprocess
 import m3u8
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from fake_useragent import UserAgent
 
 from root_anchor import ROOT_DIR
+from services.audio_processing import list_segment_files
+from services.file_hash_generator import gen_hash
 from utils import db
 
 ua = UserAgent()
 
 
+C14_REMAINING_EPISODES_CONDITION = '''e.channel_id = 1
+             AND e.local_storage IS NULL
+             AND e.download_status <> 'error'
+             AND e.duplicate_of IS NULL
+             AND e.has_transcript = 0
+'''
+
+
 def download_remaining_c14_episodes():
     return db.execute_query(
         '''SELECT e.*
            FROM episode AS e
-           WHERE e.channel_id = 1
-             AND e.local_storage IS NULL
-             AND e.download_status <> 'error'
-             AND e.duplicate_of IS NULL
-             AND e.transcripts IS NULL
+           WHERE ''' + C14_REMAINING_EPISODES_CONDITION + '''
            ORDER BY e.air_date
            LIMIT 1
         ''',
@@ -29,7 +38,48 @@ def download_remaining_c14_episodes():
     )
 
 
-def download_c14_m3u8_file(m3u8_url: str, filename: str, file_ext: str = "mp3"):
+HLS_CONCURRENCY = int(os.getenv("HLS_CONCURRENCY", 16))
+HLS_SEGMENT_RETRIES = 4
+HLS_RETRY_BACKOFF = 1.0
+HLS_SEGMENT_TIMEOUT = 30
+
+
+def hls_session() -> requests.Session:
+    session = requests.Session()
+    session.headers.update({"User-Agent": ua.chrome})
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=HLS_CONCURRENCY)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def fetch_hls_segment(session: requests.Session, seg_url: str) -> bytes:
+    for attempt in range(HLS_SEGMENT_RETRIES + 1):
+        try:
+            response = session.get(seg_url, timeout=HLS_SEGMENT_TIMEOUT)
+            response.raise_for_status()
+            return response.content
+        except requests.RequestException as e:
+            if attempt == HLS_SEGMENT_RETRIES:
+                raise
+            print("retrying segment " + seg_url + " after error: " + str(e))
+            time.sleep(HLS_RETRY_BACKOFF * 2 ** attempt)
+
+
+def iter_hls_segments(session: requests.Session, segment_urls: list[str]):
+    """Yields segment contents in playlist order while up to HLS_CONCURRENCY segments download ahead."""
+    with ThreadPoolExecutor(max_workers=HLS_CONCURRENCY) as executor:
+        window = deque()
+        next_index = 0
+        while next_index < len(segment_urls) or window:
+            while next_index < len(segment_urls) and len(window) < HLS_CONCURRENCY:
+                window.append(executor.submit(fetch_hls_segment, session, segment_urls[next_index]))
+                next_index += 1
+            yield window.popleft().result()
+
+
+def transcode_hls_stream(m3u8_url: str, output_args: list):
+    """Streams the lowest bandwidth rendition into one ffmpeg process writing output_args."""
     # Step 1: Download and parse master m3u8
     master_m3u8 = m3u8.load(m3u8_url)
     # Step 2: Find lowest bandwidth stream
@@ -37,30 +87,58 @@ def download_c14_m3u8_file(m3u8_url: str, filename: str, file_ext: str = "mp3"):
     stream_url = urllib.parse.urljoin(m3u8_url, lowest_stream.uri)
     # Step 3: Download stream playlist
     stream_m3u8 = m3u8.load(stream_url)
-    # Step 4: Download all segments
-    segment_files = []
-    for i, seg in enumerate(stream_m3u8.segments):
-        print("downloading segment " + str(i + 1) + " of " + str(len(stream_m3u8.segments)))
-        seg_url = urllib.parse.urljoin(stream_url, seg.uri)
-        seg_file = ROOT_DIR / "dir" / f"{filename}_seg{i}.ts"
-        with open(seg_file, "wb") as f:
-            f.write(requests.get(seg_url).content)
-        segment_files.append(seg_file)
-    # Step 5: Concatenate segments
-    concat_file = ROOT_DIR / "dir" / f"{filename}_concat.ts"
-    with open(concat_file, "wb") as outfile:
-        print("concatenating segments")
-        for seg_file in segment_files:
-            with open(seg_file, "rb") as infile:
-                outfile.write(infile.read())
-            os.remove(seg_file)
-    # Step 6: Convert to mp3 using ffmpeg
+    segment_urls = [urllib.parse.urljoin(stream_url, seg.uri) for seg in stream_m3u8.segments]
+    # Step 4: Download segments in parallel and stream them, in order, straight into ffmpeg
+    ffmpeg = subprocess.Popen([
+        "ffmpeg", "-y", "-f", "mpegts", "-i", "pipe:0", "-vn", "-acodec", "libmp3lame", "-ab", "32k"
+    ] + output_args, stdin=subprocess.PIPE)
+    try:
+        with hls_session() as session:
+            for i, content in enumerate(iter_hls_segments(session, segment_urls)):
+                print("downloaded segment " + str(i + 1) + " of " + str(len(segment_urls)))
+                ffmpeg.stdin.write(content)
+        ffmpeg.stdin.close()
+    except BaseException:
+        ffmpeg.kill()
+        ffmpeg.wait()
+        raise
+    if ffmpeg.wait() != 0:
+        raise subprocess.CalledProcessError(ffmpeg.returncode, "ffmpeg")
+
+
+def download_c14_m3u8_file(m3u8_url: str, filename: str, file_ext: str = "mp3") -> str:
+    """Downloads and converts the episode, returning the content hash of the converted file."""
     mp3_file = ROOT_DIR / "dir" / f"{filename}.{file_ext}"
-    subprocess.run([
-        "ffmpeg", "-y", "-i", concat_file, "-vn", "-acodec", "libmp3lame", "-ab", "32k", mp3_file
-    ], check=True)
-    os.remove(concat_file)
+    # written to a file, not a pipe, so ffmpeg seeks back to fill in the Xing header and the hash matches the
+    # content_hash values of every earlier C14 download
+    transcode_hls_stream(m3u8_url, [str(mp3_file)])
     print("done_downloading " + filename)
+    return gen_hash(mp3_file)
+
+
+def download_c14_m3u8_segments(m3u8_url: str, filename: str, segment_length: int,
+                               file_ext: str = "mp3") -> tuple[list[str], str]:
+    """Downloads the episode straight into transcription-ready parts of at most segment_length seconds.
+
+    The encoded stream is teed once: into the segment muxer for the <filename>_pN parts and into a full-length
+    file, hashed and removed afterwards, so the content hash is the same download_c14_m3u8_file would return.
+    """
+    output_dir = ROOT_DIR / "dir"
+    segment_pattern = str(output_dir / (filename + "_p%d." + file_ext))
+    full_file = output_dir / (filename + "_full." + file_ext)
+    try:
+        transcode_hls_stream(m3u8_url, [
+            "-map", "0:a", "-f", "tee",
+            "[f=segment:segment_time=" + str(segment_length) + ":segment_start_number=1:reset_timestamps=1]" +
+            segment_pattern + "|[f=" + file_ext + "]" + str(full_file)
+        ])
+        content_hash = gen_hash(full_file)
+    finally:
+        if full_file.exists():
+            os.remove(full_file)
+    segments = list_segment_files(output_dir, filename, file_ext)
+    print("done_downloading " + filename + " in " + str(len(segments)) + " parts")
+    return segments, content_hash
 
 
 if __name__ == "__main__":
@@ -1,27 +1,84 @@
 import json
+import os
+import threading
+from datetime import timedelta
 from os import remove
 from typing import Literal, Optional
 
 from fake_useragent import UserAgent
 import time
-from pydub import AudioSegment
 
-from episode_transcriber import transcribe_batch_gcs_input_inline_output_v2
-from google_cloud_storage_manager import upload_blob, delete_blob
+from episode_transcriber import batch_transcriber, submit_batch_recognize
+from google_cloud_storage_manager import upload_blobs, start_uploads, delete_blobs
 from root_anchor import ROOT_DIR
-from services.c14_episode_downloader import download_remaining_c14_episodes, download_c14_m3u8_file
+from services.audio_processing import SPLIT_MODE, split_audio, prepare_for_transcription, map_offset
+from services.audio_fingerprint import DUPLICATE_COVERAGE, PARTIAL_DUPLICATE_COVERAGE, fingerprint_files, \
+    find_overlap, store_fingerprint
+from services.c14_episode_downloader import download_remaining_c14_episodes, download_c14_m3u8_file, \
+    download_c14_m3u8_segments
 from services.file_hash_generator import gen_hash
-from services.glz_episode_downloader import download_remaining_glz_episodes, download_glz_mp3_file
+from services.glz_episode_downloader import download_remaining_glz_episodes, download_glz_mp3_file, remote_fingerprint
+from services.local_search_index import SEARCH_BACKEND, add_episode_to_local_index
+from services.local_transcriber import local_transcriber
+from services.transcript_segment_indexer import index_episode_transcripts
+from services.transcript_store import TRANSCRIPT_STORAGE, save_episode_transcripts
 from utils import db
+from utils.transcripts import parse_offset
 
 ua = UserAgent()
 
 SOURCE_TYPE = Literal["glz", "c14"]
+# transcode C14 episodes directly into their transcription parts instead of writing and re-splitting a full file
+C14_SINGLE_PASS = os.getenv("C14_SINGLE_PASS", "1") == "1"
+# "google" transcribes uploaded parts with Speech-to-Text, "whisper" transcribes the local files on this machine
+TRANSCRIBE_BACKEND = os.getenv("TRANSCRIBE_BACKEND", "google")
+# also match episodes by their audio fingerprint (needs Chromaprint's fpcalc), catching reruns that differ in
+# ads, jingles or intros and so never hash the same
+AUDIO_FINGERPRINT = os.getenv("AUDIO_FINGERPRINT", "0") == "1"
+# "sync" waits for recognition in the worker, "async" submits it and leaves collection to the transcription poller;
+# local transcription always runs in the worker
+TRANSCRIBE_MODE = os.getenv("TRANSCRIBE_MODE", "sync") if TRANSCRIBE_BACKEND == "google" else "sync"
+TRANSCRIBERS = {
+    "google": batch_transcriber,
+    "whisper": local_transcriber,
+}
+REPORT_INTERVAL = int(os.getenv("PIPELINE_REPORT_INTERVAL", 60))
+
+
+class ThroughputCounter:
+    """Counts finished episodes from any thread and prints the throughput at most once every report_interval."""
+
+    def __init__(self, name: str, report_interval: int = REPORT_INTERVAL):
+        self.name = name
+        self.report_interval = report_interval
+        self.processed = 0
+        self.failed = 0
+        self.start = time.time()
+        self._last_report = self.start
+        self._lock = threading.Lock()
+
+    def add(self, failed: bool = False):
+        with self._lock:
+            if failed:
+                self.failed += 1
+            else:
+                self.processed += 1
+            due = time.time() - self._last_report >= self.report_interval
+            if due:
+                self._last_report = time.time()
+        if due:
+            print(self.report())
+
+    def report(self) -> str:
+        with self._lock:
+            elapsed = time.time() - self.start
+            per_hour = self.processed / elapsed * 3600 if elapsed else 0
+            return (self.name + ": " + str(self.processed) + " done, " + str(self.failed) + " failed, " +
+                    f"{per_hour:.1f}/h over {int(elapsed)}s")
 
 
 def download_remaining_episodes(source_type: SOURCE_TYPE):
-    start = time.time()
-    download_count = 0
+    counter = ThroughputCounter(source_type + " episodes")
     while True:
         episode_to_download = None
         if source_type == "glz":
@@ -29,12 +86,10 @@ def download_remaining_episodes(source_type: SOURCE_TYPE):
         elif source_type == "c14":
             episode_to_download = download_remaining_c14_episodes()
         if episode_to_download is None:
+            print(counter.report())
             return
         process_episode(episode_to_download["id"], source_type)
-        end = time.time()
-        download_count += 1
-        print("**** INTERIM PROGRESS REPORT: downloaded " + str(download_count) + " episodes, time elapsed: " +
-              str(end - start) + " seconds ****")
+        counter.add()
 
 
 def set_episode_download_status(episode_id: int, status: Literal["not downloaded", "downloaded", "error", "in progress"], error: Optional[str] = None):
@@ -65,8 +120,9 @@ def process_episode(episode_id: int, source_type: SOURCE_TYPE):
     if episode["download_status"] == "not downloaded" or episode["download_status"] == "in progress":
         set_episode_download_status(episode_id, "in progress")
         try:
-            set_episode_download_status(episode_id, "downloaded")
             segments = download_episode(episode, source_type)
+            # only marked downloaded once the files exist, so an interrupted download stays reclaimable
+            set_episode_download_status(episode_id, "downloaded")
         except Exception as e:
             print(str(e))
             set_episode_download_status(episode_id, "error", str(e)[0:300])
@@ -82,19 +138,95 @@ def process_episode(episode_id: int, source_type: SOURCE_TYPE):
 
 
 def download_episode(episode: dict, source_type: SOURCE_TYPE) -> Optional[list[str]]:
+    if precheck_remote_duplicate(episode, source_type):
+        return None
+    episode_filename, content_hash, file_segments = fetch_episode_file(episode, source_type)
+    # check if the episode is a duplicate of an already existing episode
+    if deduplicate_episode_file(episode["id"], episode_filename, content_hash, file_segments):
+        return None
+    return split_episode_file(episode["id"], episode_filename, file_segments)
+
+
+def episode_file_name(episode: dict) -> str:
+    return str(episode["air_date"]) + "_" + str(episode["id"]).zfill(10)
+
+
+def precheck_remote_duplicate(episode: dict, source_type: SOURCE_TYPE) -> bool:
+    """Fingerprints the remote file before downloading it. A fingerprint match whose ETag also matches is
+    marked duplicate right away; any other match is left to the full content hash after the download."""
+    if source_type != "glz":
+        return False
     episode_id = episode["id"]
+    remote = remote_fingerprint(episode["file_url"])
+    if remote is None:
+        return False
+    db.execute_query(
+        '''UPDATE episode SET remote_fingerprint = %(fingerprint)s, remote_etag = %(etag)s
+        WHERE id = %(id)s
+        ''',
+        {"id": episode_id, "fingerprint": remote["fingerprint"], "etag": remote["etag"]}, "id"
+    )
+    candidates = db.execute_query(
+        '''SELECT e.id, e.remote_etag FROM episode AS e
+        WHERE e.remote_fingerprint = %(fingerprint)s
+         AND e.id <> %(id)s
+         AND e.duplicate_of IS NULL
+         AND e.content_hash IS NOT NULL
+        ORDER BY e.id
+        ''',
+        {"id": episode_id, "fingerprint": remote["fingerprint"]}, "rows"
+    ) or []
+    if not candidates:
+        return False
+    confirmed = [c for c in candidates if remote["etag"] and c["remote_etag"] == remote["etag"]]
+    if not confirmed:
+        print("episode is likely a duplicate of episode " + str(candidates[0]["id"]) + ", confirming after download")
+        return False
+    print("episode is duplicate of episode " + str(confirmed[0]["id"]) + " (remote fingerprint), skipping download")
+    db.execute_query(
+        '''UPDATE episode SET duplicate_of = %(duplicate_of)s
+        WHERE id = %(id)s
+        ''',
+        {"id": episode_id, "duplicate_of": confirmed[0]["id"]}, "id"
+    )
+    set_episode_download_status(episode_id, "downloaded")
+    return True
+
+
+def fetch_episode_file(episode: dict, source_type: SOURCE_TYPE) -> tuple[str, Optional[str], Optional[list[str]]]:
+    """Downloads the episode and returns its file name with the content hash computed during the download.
+    Sources that are transcoded straight into parts also return those parts, otherwise the parts are None."""
     download_url = episode["file_url"]
-    episode_filename = str(episode["air_date"]) + "_" + str(episode_id).zfill(10)
+    episode_filename = episode_file_name(episode)
+    content_hash = None
+    file_segments = None
     if source_type == "glz":
-        download_glz_mp3_file(download_url, episode_filename)
+        content_hash = download_glz_mp3_file(download_url, episode_filename)
+    elif source_type == "c14" and C14_SINGLE_PASS and SPLIT_MODE != "vad":
+        file_segments, content_hash = download_c14_m3u8_segments(download_url, episode_filename, MAX_SEGMENT_LENGTH)
     elif source_type == "c14":
-        download_c14_m3u8_file(download_url, episode_filename)
-    # check if the episode is a duplicate of an already existing episode
-    print("hashing episode")
-    episode_hash = gen_hash(ROOT_DIR / "dir" /  episode_filename + ".mp3")
+        content_hash = download_c14_m3u8_file(download_url, episode_filename)
+    return episode_filename, content_hash, file_segments
+
+
+def remove_episode_files(episode_filename: str, file_segments: Optional[list[str]] = None):
+    print("removing file")
+    if file_segments is None:
+        remove(ROOT_DIR / "dir" / (episode_filename + ".mp3"))
+    else:
+        for s in file_segments:
+            remove(ROOT_DIR / "dir" / s)
+    print("removed file")
+
+
+def deduplicate_episode_file(episode_id: int, episode_filename: str, episode_hash: Optional[str] = None,
+                             file_segments: Optional[list[str]] = None) -> bool:
+    if episode_hash is None:
+        print("hashing episode")
+        episode_hash = gen_hash(ROOT_DIR / "dir" / (episode_filename + ".mp3"))
     print("searching for previous airings of the same content")
     previous_airings = db.execute_query(
-        '''SELECT * FROM episode
+        '''SELECT id FROM episode
         WHERE content_hash = %(content_hash)s
         ''',
         {"content_hash": episode_hash},
@@ -102,17 +234,8 @@ def download_episode(episode: dict, source_type: SOURCE_TYPE) -> Optional[list[s
     )
     if previous_airings:
         print("episode is duplicate of episode " + str(previous_airings["id"]))
-        db.execute_query(
-            '''UPDATE episode SET duplicate_of = %(duplicate_of)s
-            WHERE id = %(id)s
-            ''',
-            {"id": episode_id, "duplicate_of": previous_airings["id"]}, "id"
-        )
-        print("removing file")
-        remove(ROOT_DIR / "dir" /  episode_filename + ".mp3")
-        print("removed file")
-        set_episode_download_status(episode_id, "downloaded")
-        return None
+        mark_duplicate_episode(episode_id, previous_airings["id"], episode_filename, file_segments)
+        return True
     print("storing episode hash")
     db.execute_query(
         '''UPDATE episode SET content_hash = %(content_hash)s
@@ -120,59 +243,248 @@ def download_episode(episode: dict, source_type: SOURCE_TYPE) -> Optional[list[s
         ''',
         {"id": episode_id, "content_hash": episode_hash}, "id"
     )
-    print("splitting episode for processing (because Google Cloud Speech-to-Text has a 1 hour limit)")
-    file_segments = split_file(episode_filename)
+    if AUDIO_FINGERPRINT:
+        return deduplicate_by_fingerprint(episode_id, episode_filename, file_segments)
+    return False
+
+
+def mark_duplicate_episode(episode_id: int, duplicate_of: int, episode_filename: str,
+                           file_segments: Optional[list[str]] = None):
+    db.execute_query(
+        '''UPDATE episode SET duplicate_of = %(duplicate_of)s
+        WHERE id = %(id)s
+        ''',
+        {"id": episode_id, "duplicate_of": duplicate_of}, "id"
+    )
+    remove_episode_files(episode_filename, file_segments)
+    set_episode_download_status(episode_id, "downloaded")
+
+
+def deduplicate_by_fingerprint(episode_id: int, episode_filename: str, file_segments: Optional[list[str]] = None) -> bool:
+    """Marks an episode whose audio is mostly covered by an earlier one as its duplicate. A smaller overlap is
+    recorded in duplicate_spans, which split_episode_file leaves out so only the new audio is transcribed."""
+    print("fingerprinting episode audio")
+    file_names = file_segments if file_segments is not None else [episode_filename + ".mp3"]
+    fingerprint = fingerprint_files([ROOT_DIR / "dir" / f for f in file_names])
+    overlap = find_overlap(episode_id, fingerprint)
+    if overlap and overlap["coverage"] >= DUPLICATE_COVERAGE:
+        print("episode is duplicate of episode " + str(overlap["episode_id"]) +
+              f" ({overlap['coverage']:.0%} of the audio matches)")
+        mark_duplicate_episode(episode_id, overlap["episode_id"], episode_filename, file_segments)
+        return True
+    store_fingerprint(episode_id, fingerprint)
+    # parts transcoded during the download are already cut, so only whole files skip the shared spans
+    if overlap and overlap["coverage"] >= PARTIAL_DUPLICATE_COVERAGE and file_segments is None:
+        print(f"{overlap['coverage']:.0%} of the episode is shared with episode " + str(overlap["episode_id"]) +
+              ", transcribing only the rest")
+        db.execute_query(
+            '''UPDATE episode SET partial_duplicate_of = %(duplicate_of)s, duplicate_spans = %(spans)s
+            WHERE id = %(id)s
+            ''',
+            {"id": episode_id, "duplicate_of": overlap["episode_id"], "spans": json.dumps(overlap["spans"])}, "id"
+        )
+    return False
+
+
+def load_duplicate_spans(episode_id: int) -> Optional[list[tuple[float, float]]]:
+    episode = db.execute_query(
+        '''SELECT e.duplicate_spans FROM episode AS e WHERE e.id = %(id)s''',
+        {"id": episode_id}, "single_row"
+    )
+    return [tuple(s) for s in json.loads(episode["duplicate_spans"])] if episode and episode["duplicate_spans"] else None
+
+
+def split_episode_file(episode_id: int, episode_filename: str, file_segments: Optional[list[str]] = None) -> list[str]:
+    split_now = file_segments is None
+    if split_now:
+        print("splitting episode for processing (because Google Cloud Speech-to-Text has a 1 hour limit)")
+        file_segments, segment_offsets = split_file(episode_filename, exclude=load_duplicate_spans(episode_id))
+    else:
+        segment_offsets = [float(i * MAX_SEGMENT_LENGTH) for i in range(len(file_segments))]
     print("storing file links")
     db.execute_query(
-        '''UPDATE episode SET local_storage = %(file_segments)s
+        '''UPDATE episode SET local_storage = %(file_segments)s, segment_offsets = %(segment_offsets)s
         WHERE id = %(id)s
         ''',
-        {"id": episode_id, "file_segments": json.dumps(file_segments)}, "id"
+        {"id": episode_id, "file_segments": json.dumps(file_segments), "segment_offsets": json.dumps(segment_offsets)},
+        "id"
     )
-    print("removing file")
-    remove(ROOT_DIR / "dir" /  episode_filename + ".mp3")
-    print("removed file")
+    if split_now:
+        remove_episode_files(episode_filename)
     return file_segments
 
 
-MAX_SEGMENT_LENGTH = 3600
+# Speech-to-Text rejects files over an hour; local transcription has no limit but still gets one part per process
+MAX_SEGMENT_LENGTH = int(os.getenv("MAX_SEGMENT_LENGTH", 3600))
 
 
-def split_file(file_name: str, file_ext: str = "mp3") -> list[str]:
-    file_path = ROOT_DIR / "dir" /  file_name + "." + file_ext
-    print("reading audio file " + file_name)
-    audio = AudioSegment.from_file(file_path)
-    print("checking audio length for file " + file_name)
-    segment_length = audio.duration_seconds
-    segment_count = 0
-    segments = []
+def split_file(file_name: str, file_ext: str = "mp3",
+               exclude: Optional[list[tuple[float, float]]] = None) -> tuple[list[str], list[float]]:
+    file_path = ROOT_DIR / "dir" / (file_name + "." + file_ext)
     print("splitting file " + file_name)
-    for start in range(0, int(segment_length), MAX_SEGMENT_LENGTH):
-        segment_count += 1
-        print("creating segment " + str(segment_count))
-        segment_audio = audio[start * 1000: int(min(start + MAX_SEGMENT_LENGTH, int(segment_length))) * 1000]
-        segment_file_name = file_name + "_p" + str(segment_count) + '.' + file_ext
-        segment_audio.export(ROOT_DIR / "dir" /  segment_file_name, format=file_ext, bitrate='32k')
-        segments.append(segment_file_name)
-        print("exported segment " + str(segment_count))
-    return segments
+    segments, segment_offsets = split_audio(file_path, file_name, file_ext, MAX_SEGMENT_LENGTH, exclude)
+    print("exported " + str(len(segments)) + " segments")
+    return segments, segment_offsets
+
+
+def load_segment_offsets(episode_id: int) -> Optional[list[float]]:
+    """Where each part starts in the episode; None for episodes split before the offsets were recorded."""
+    episode = db.execute_query(
+        '''SELECT e.segment_offsets FROM episode AS e WHERE e.id = %(id)s''',
+        {"id": episode_id}, "single_row"
+    )
+    return json.loads(episode["segment_offsets"]) if episode and episode["segment_offsets"] else None
 
 
 def analyze_segments(file_segments: list[str], episode_id: int):
+    prepared_segments = prepare_segments(file_segments, load_segment_offsets(episode_id))
+    upload_segments(prepared_segments)
+    if TRANSCRIBE_MODE == "async":
+        submit_transcription_jobs(episode_id, prepared_segments)
+        return
+    transcript_parts = transcribe_segments(prepared_segments)
+    store_transcripts(episode_id, transcript_parts)
+
+
+JOB_WRITE_ATTEMPTS = 3
+
+
+def record_transcription_jobs(episode_id: int, operation_name: str, jobs: list[dict]):
+    """Replaces the episode's job rows with the parts of the new operation, dropping rows left by an earlier
+    submission with more parts. Raises once every attempt failed, since an operation nobody recorded would never
+    be collected."""
+    for attempt in range(JOB_WRITE_ATTEMPTS):
+        try:
+            with db.transaction() as cursor:
+                cursor.execute(
+                    '''DELETE FROM transcription_job WHERE episode_id = %(episode_id)s''',
+                    {"episode_id": episode_id}
+                )
+                cursor.executemany(
+                    '''INSERT INTO transcription_job (`episode_id`, `part`, `gcs_object`, `audio_format`, `kept_intervals`, `operation_name`)
+                    VALUES (%(episode_id)s, %(part)s, %(gcs_object)s, %(audio_format)s, %(kept_intervals)s, %(operation_name)s)''',
+                    jobs
+                )
+            return
+        except Exception as e:
+            print("could not record transcription jobs of episode " + str(episode_id) + ": " + str(e))
+            if attempt + 1 == JOB_WRITE_ATTEMPTS:
+                raise RuntimeError("transcription " + operation_name + " of episode " + str(episode_id) +
+                                   " was submitted but could not be recorded") from e
+            time.sleep(2 ** attempt)
+
+
+def submit_transcription_jobs(episode_id: int, prepared_segments: list[dict]):
+    """Starts recognition of all parts and records the operation instead of waiting for it;
+    services/transcription_poller.py stores the transcript once the operation finishes."""
+    audio_format = prepared_segments[0]["format"] if prepared_segments else None
+    operation = submit_batch_recognize([p["file"] for p in prepared_segments], audio_format)
+    operation_name = operation.operation.name
+    print("submitted transcription of episode " + str(episode_id) + " as " + operation_name)
+    record_transcription_jobs(episode_id, operation_name, [{
+        "episode_id": episode_id,
+        "part": i,
+        "gcs_object": p["file"],
+        "audio_format": p["format"],
+        "kept_intervals": json.dumps(p["kept"]),
+        "operation_name": operation_name,
+    } for i, p in enumerate(prepared_segments)])
+    for p in prepared_segments:
+        if p["format"]:
+            remove(ROOT_DIR / "dir" / p["file"])
+
+
+def prepare_segments(file_segments: list[str], segment_offsets: Optional[list[float]] = None) -> list[dict]:
+    prepared_segments = [prepare_for_transcription(ROOT_DIR / "dir" / s) for s in file_segments]
+    for i, p in enumerate(prepared_segments):
+        p["start"] = segment_offsets[i] if segment_offsets else None
+    if any(p["format"] for p in prepared_segments):
+        original_bytes = sum(p["original_bytes"] for p in prepared_segments)
+        prepared_bytes = sum(p["prepared_bytes"] for p in prepared_segments)
+        original_seconds = sum(p["original_seconds"] for p in prepared_segments)
+        prepared_seconds = sum(p["prepared_seconds"] for p in prepared_segments)
+        print("prepared audio for transcription: " +
+              f"{original_bytes / 1e6:.1f}MB -> {prepared_bytes / 1e6:.1f}MB " +
+              f"(saved {original_bytes - prepared_bytes} bytes), " +
+              f"{original_seconds:.0f}s -> {prepared_seconds:.0f}s (saved {original_seconds - prepared_seconds:.0f}s)")
+    return prepared_segments
+
+
+def upload_segments(prepared_segments: list[dict]):
+    if not TRANSCRIBERS[TRANSCRIBE_BACKEND].remote:
+        return
+    # all parts upload in parallel, so an episode takes as long as its slowest part
+    upload_blobs([(ROOT_DIR / "dir" / p["file"], p["file"]) for p in prepared_segments])
+
+
+def start_segment_uploads(prepared_segments: list[dict]) -> list:
+    """Like upload_segments, but returns the upload futures instead of waiting for them."""
+    if not TRANSCRIBERS[TRANSCRIBE_BACKEND].remote:
+        return []
+    return start_uploads([(ROOT_DIR / "dir" / p["file"], p["file"]) for p in prepared_segments])
+
+
+def restore_original_offsets(segment_transcript: list[dict], kept: Optional[list], start: Optional[float] = None):
+    """Shifts offsets of silence-trimmed audio back onto the timeline of the episode part, and with the part's
+    start known, onto the timeline of the whole episode; such parts are marked with absolute_offsets."""
+    if not kept and start is None:
+        return
+    for response in segment_transcript:
+        for result in response["transcript"]["results"]:
+            offset = parse_offset(result["offset"])
+            if offset is not None:
+                result["offset"] = str(timedelta(seconds=map_offset(offset, kept) + (start or 0.0)))
+        if start is not None:
+            response["start_offset"] = start
+            response["absolute_offsets"] = True
+
+
+def transcribe_segments(prepared_segments: list[dict]) -> list[list[dict]]:
+    # all parts are queued at once, so they share BatchRecognize requests (or the local process pool)
+    # with each other and with other episodes
+    transcriber = TRANSCRIBERS[TRANSCRIBE_BACKEND]
+    futures = [
+        transcriber.submit(p["file"] if transcriber.remote else ROOT_DIR / "dir" / p["file"], p["format"])
+        for p in prepared_segments
+    ]
     transcript_parts = []
-    for s in file_segments:
-        # uploading segment
-        upload_blob(ROOT_DIR / "dir" /  s, s)
-        # transcribe segment
-        segment_transcript = transcribe_batch_gcs_input_inline_output_v2(s)
+    for p, future in zip(prepared_segments, futures):
+        segment_transcript = future.result()
+        restore_original_offsets(segment_transcript, p["kept"], p["start"])
         transcript_parts.append(segment_transcript)
-        print("removing segment")
-        delete_blob(s)
+        if p["format"]:
+            remove(ROOT_DIR / "dir" / p["file"])
         # remove(ROOT_DIR / "dir" /  s)
+    if transcriber.remote:
+        print("removing segments")
+        delete_blobs([p["file"] for p in prepared_segments])
+    return transcript_parts
+
+
+def store_transcripts(episode_id: int, transcript_parts: list[list[dict]]):
     print("storing transcript")
-    db.execute_query(
-        '''UPDATE episode SET transcripts = %(transcript_parts)s
-        WHERE id = %(id)s
-        ''',
-        {"id": episode_id, "transcript_parts": json.dumps(transcript_parts, ensure_ascii=False).encode('utf8')}, "id"
-    )
\ No newline at end of file
+    if TRANSCRIPT_STORAGE == "table":
+        # raises when the row was not written, so the inline transcripts are only dropped once stored
+        save_episode_transcripts(episode_id, transcript_parts)
+        db.execute_query(
+            '''UPDATE episode SET transcripts = NULL, has_transcript = 1, payload_version = payload_version + 1
+            WHERE id = %(id)s
+            ''',
+            {"id": episode_id}, "id"
+        )
+    else:
+        db.execute_query(
+            '''UPDATE episode SET transcripts = %(transcript_parts)s, has_transcript = 1, payload_version = payload_version + 1
+            WHERE id = %(id)s
+            ''',
+            {"id": episode_id, "transcript_parts": json.dumps(transcript_parts, ensure_ascii=False).encode('utf8')}, "id"
+        )
+        # a migrated copy would otherwise shadow the new inline transcripts
+        db.execute_query(
+            '''DELETE FROM episode_transcript WHERE episode_id = %(id)s''',
+            {"id": episode_id}, "none"
+        )
+    print("indexing transcript segments")
+    index_episode_transcripts(episode_id, transcript_parts)
+    if SEARCH_BACKEND == "local":
+        add_episode_to_local_index(episode_id, transcript_parts)
@@ -0,0 +1,95 @@
+import gzip
+import json
+import os
+import threading
+from typing import Optional
+
+from cachetools import LRUCache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# total bytes of cached payloads, counting every stored encoding
+EPISODE_CACHE_BYTES = int(os.getenv("EPISODE_CACHE_BYTES", 256 * 1024 * 1024))
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+class EpisodePayload:
+    """A serialized episode response, compressed once in every encoding the server can send."""
+
+    def __init__(self, episode_id: int, version: int, body: bytes):
+        self.episode_id = episode_id
+        self.version = version
+        self.etag = payload_etag(episode_id, version)
+        self.bodies = {"identity": body, "gzip": gzip.compress(body, GZIP_LEVEL)}
+        if brotli is not None:
+            self.bodies["br"] = brotli.compress(body, quality=BROTLI_QUALITY)
+
+    @property
+    def size(self) -> int:
+        return sum(len(b) for b in self.bodies.values())
+
+    def body(self, encoding: str) -> bytes:
+        return self.bodies[encoding]
+
+
+def payload_etag(episode_id: int, version: int) -> str:
+    # weak, since the same payload is sent in several content encodings
+    return 'W/"episode-' + str(episode_id) + "-" + str(version) + '"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [c.strip() for c in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates or etag[2:] in candidates
+
+
+def choose_encoding(accept_encoding: Optional[str], payload: EpisodePayload) -> str:
+    accepted = {}
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+    for encoding in ("br", "gzip"):
+        if encoding in payload.bodies and accepted.get(encoding, 0) > 0:
+            return encoding
+    return "identity"
+
+
+class EpisodePayloadCache:
+    """Payloads keyed by episode id, each valid for one episode.payload_version; a payload of an older version
+    is never served, so bumping the version is all the invalidation a change needs."""
+
+    def __init__(self, max_bytes: int = EPISODE_CACHE_BYTES):
+        self._payloads = LRUCache(maxsize=max_bytes, getsizeof=lambda p: p.size)
+        self._lock = threading.Lock()
+
+    def get(self, episode_id: int, version: int) -> Optional[EpisodePayload]:
+        with self._lock:
+            payload = self._payloads.get(episode_id)
+        if payload is None or payload.version != version:
+            return None
+        return payload
+
+    def put(self, episode_id: int, version: int, content: dict) -> EpisodePayload:
+        payload = EpisodePayload(episode_id, version, json.dumps(content, ensure_ascii=False).encode("utf8"))
+        if payload.size <= self._payloads.maxsize:
+            with self._lock:
+                self._payloads[episode_id] = payload
+        return payload
+
+    def invalidate(self, episode_id: int):
+        with self._lock:
+            self._payloads.pop(episode_id, None)
+
+
+episode_payload_cache = EpisodePayloadCache()
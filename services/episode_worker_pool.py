@@ -0,0 +1,115 @@
+import multiprocessing
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
+from typing import Literal, Optional
+
+from services.c14_episode_downloader import C14_REMAINING_EPISODES_CONDITION
+from services.episode_downloader import SOURCE_TYPE, ThroughputCounter, process_episode
+from services.glz_episode_downloader import GLZ_REMAINING_EPISODES_CONDITION
+from utils import db
+
+PIPELINE_WORKERS = int(os.getenv("PIPELINE_WORKERS", 4))
+# a claimed episode is reclaimable by other workers once its lease expires without being renewed
+EPISODE_LEASE_SECONDS = int(os.getenv("EPISODE_LEASE_SECONDS", 1800))
+
+REMAINING_EPISODES_CONDITIONS = {
+    "glz": GLZ_REMAINING_EPISODES_CONDITION,
+    "c14": C14_REMAINING_EPISODES_CONDITION,
+}
+
+
+def claim_next_episode(source_type: SOURCE_TYPE, worker_id: str) -> Optional[int]:
+    # the conditional UPDATE is atomic, so two workers can never claim the same row
+    claim_id = worker_id + ":" + uuid.uuid4().hex[:8]
+    db.execute_query(
+        '''UPDATE episode AS e
+           SET e.download_status = 'in progress',
+               e.worker_id = %(claim_id)s,
+               e.lease_expires = NOW() + INTERVAL %(lease_seconds)s SECOND
+           WHERE ''' + REMAINING_EPISODES_CONDITIONS[source_type] + '''
+             AND (e.download_status = 'not downloaded'
+                  OR (e.download_status = 'in progress' AND (e.lease_expires IS NULL OR e.lease_expires < NOW())))
+           ORDER BY e.air_date
+           LIMIT 1
+        ''',
+        {"claim_id": claim_id, "lease_seconds": EPISODE_LEASE_SECONDS}, "none"
+    )
+    claimed = db.execute_query(
+        '''SELECT e.id FROM episode AS e WHERE e.worker_id = %(claim_id)s''',
+        {"claim_id": claim_id}, "single_row"
+    )
+    return claimed["id"] if claimed else None
+
+
+def renew_lease(episode_id: int, claim_id_prefix: str):
+    db.execute_query(
+        '''UPDATE episode SET lease_expires = NOW() + INTERVAL %(lease_seconds)s SECOND
+        WHERE id = %(id)s AND LEFT(worker_id, %(prefix_length)s) = %(worker_id)s
+        ''',
+        {"id": episode_id, "worker_id": claim_id_prefix + ":", "prefix_length": len(claim_id_prefix) + 1,
+         "lease_seconds": EPISODE_LEASE_SECONDS}, "none"
+    )
+
+
+def release_lease(episode_id: int, claim_id_prefix: str):
+    db.execute_query(
+        '''UPDATE episode SET lease_expires = NULL
+        WHERE id = %(id)s AND LEFT(worker_id, %(prefix_length)s) = %(worker_id)s
+        ''',
+        {"id": episode_id, "worker_id": claim_id_prefix + ":", "prefix_length": len(claim_id_prefix) + 1}, "none"
+    )
+
+
+def process_claimed_episode(episode_id: int, source_type: SOURCE_TYPE, worker_id: str):
+    # keep renewing the lease while the episode is processed, transcription alone can take hours
+    done = threading.Event()
+
+    def heartbeat():
+        while not done.wait(EPISODE_LEASE_SECONDS / 3):
+            renew_lease(episode_id, worker_id)
+
+    heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+    heartbeat_thread.start()
+    try:
+        process_episode(episode_id, source_type)
+    finally:
+        done.set()
+        heartbeat_thread.join()
+        release_lease(episode_id, worker_id)
+
+
+def run_worker(source_type: SOURCE_TYPE, worker_id: str) -> int:
+    counter = ThroughputCounter(worker_id)
+    while True:
+        episode_id = claim_next_episode(source_type, worker_id)
+        if episode_id is None:
+            print(counter.report())
+            return counter.processed
+        process_claimed_episode(episode_id, source_type, worker_id)
+        counter.add()
+
+
+def download_remaining_episodes_concurrently(
+        source_type: SOURCE_TYPE,
+        workers: int = PIPELINE_WORKERS,
+        pool_type: Literal["thread", "process"] = "thread"
+) -> int:
+    """Drains the download queue with several workers; safe to run on several machines at once."""
+    start = time.time()
+    host = socket.gethostname() + "-" + str(os.getpid())
+    if pool_type == "thread":
+        executor = ThreadPoolExecutor(max_workers=workers)
+    else:
+        # spawned rather than forked, so every worker opens its own MySQL pool instead of sharing the parent's sockets
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    with executor:
+        futures = [executor.submit(run_worker, source_type, host + "-" + str(i)) for i in range(workers)]
+        wait(futures)
+    processed = sum(f.result() for f in futures)
+    print("processed " + str(processed) + " episodes with " + str(workers) + " workers in " +
+          str(time.time() - start) + " seconds")
+    return processed
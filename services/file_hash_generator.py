@@ -2,22 +2,62 @@ import hashlib
 
 # BUF_SIZE is totally arbitrary, change for your app!
 import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
 
+from root_anchor import ROOT_DIR
 from utils import db
 
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
 BUF_SIZE = 65536  # lets read stuff in 64kb chunks!
+# md5 hashes are stored bare for compatibility with existing content_hash values, other algorithms as "name:hex"
+HASH_ALGORITHM = os.getenv("CONTENT_HASH_ALGORITHM", "md5")
 
 
-def gen_hash(path: str):
-    md5 = hashlib.md5()
+def new_hash(algorithm: str):
+    if algorithm == "xxh3_128":
+        if xxhash is None:
+            raise ImportError("xxhash is required for CONTENT_HASH_ALGORITHM=xxh3_128")
+        return xxhash.xxh3_128()
+    return hashlib.new(algorithm)
 
-    with open(path, 'rb') as f:
-        while True:
-            data = f.read(BUF_SIZE)
-            if not data:
-                break
-            md5.update(data)
-    return md5.hexdigest()
+
+class ContentHasher:
+    """Incremental content hash, fed while a file is downloaded or written."""
+
+    def __init__(self, algorithm: str = HASH_ALGORITHM):
+        self.algorithm = algorithm
+        self._hash = new_hash(algorithm)
+
+    def reset(self):
+        self._hash = new_hash(self.algorithm)
+
+    def update(self, data: bytes):
+        self._hash.update(data)
+
+    def update_from_file(self, path):
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(BUF_SIZE)
+                if not data:
+                    break
+                self._hash.update(data)
+
+    def hexdigest(self) -> str:
+        if self.algorithm == "md5":
+            return self._hash.hexdigest()
+        return self.algorithm + ":" + self._hash.hexdigest()
+
+
+def gen_hash(path: str):
+    hasher = ContentHasher()
+    hasher.update_from_file(path)
+    return hasher.hexdigest()
 
 
 def find_duplicates():
@@ -39,7 +79,7 @@ def find_duplicates():
         episode_filename = json.loads(episode_to_download["local_storage"])[0]
         episode_hash = gen_hash("./dir/" + episode_filename)
         previous_airings = db.execute_query(
-            '''SELECT * FROM episode
+            '''SELECT id FROM episode
             WHERE content_hash = %(content_hash)s
             ''',
             {"content_hash": episode_hash},
@@ -60,4 +100,105 @@ def find_duplicates():
                 WHERE id = %(id)s
                 ''',
                 {"id": episode_id, "content_hash": episode_hash}, "id"
-            )
\ No newline at end of file
+            )
+
+
+DEDUPE_BATCH_SIZE = 1000
+
+
+def hash_episode_file(file_name: str) -> Optional[str]:
+    try:
+        return gen_hash(ROOT_DIR / "dir" / file_name)
+    except FileNotFoundError:
+        return None
+
+
+def resolve_duplicates(hashed: list[tuple[int, str]]) -> tuple[dict[int, str], dict[int, int]]:
+    """Splits (episode_id, hash) pairs, in air date order, into new originals and duplicates of an earlier
+    airing, looking all the hashes up in one indexed query."""
+    args = {"hash_" + str(i): h for i, (_, h) in enumerate(hashed)}
+    existing = db.execute_query(
+        '''SELECT e.id, e.content_hash FROM episode AS e
+        WHERE e.content_hash IN (''' + ", ".join("%(" + k + ")s" for k in args) + ''')
+         AND e.duplicate_of IS NULL
+        ORDER BY e.id
+        ''',
+        args, "rows"
+    ) or []
+    originals_by_hash = {}
+    for e in existing:
+        originals_by_hash.setdefault(e["content_hash"], e["id"])
+    originals = {}
+    duplicates = {}
+    for episode_id, episode_hash in hashed:
+        if episode_hash in originals_by_hash:
+            duplicates[episode_id] = originals_by_hash[episode_hash]
+        else:
+            originals_by_hash[episode_hash] = episode_id
+            originals[episode_id] = episode_hash
+    return originals, duplicates
+
+
+def store_dedupe_results(originals: dict[int, str], duplicates: dict[int, int]):
+    if not originals and not duplicates:
+        return
+    args = {}
+    hash_cases = []
+    duplicate_cases = []
+    for i, (episode_id, episode_hash) in enumerate(originals.items()):
+        args["o_id_" + str(i)] = episode_id
+        args["o_hash_" + str(i)] = episode_hash
+        hash_cases.append("WHEN %(o_id_" + str(i) + ")s THEN %(o_hash_" + str(i) + ")s")
+    for i, (episode_id, duplicate_of) in enumerate(duplicates.items()):
+        args["d_id_" + str(i)] = episode_id
+        args["d_of_" + str(i)] = duplicate_of
+        duplicate_cases.append("WHEN %(d_id_" + str(i) + ")s THEN %(d_of_" + str(i) + ")s")
+    assignments = []
+    if hash_cases:
+        assignments.append("content_hash = CASE id " + " ".join(hash_cases) + " ELSE content_hash END")
+    if duplicate_cases:
+        assignments.append("duplicate_of = CASE id " + " ".join(duplicate_cases) + " ELSE duplicate_of END")
+    ids = [k for k in args if k.startswith("o_id_") or k.startswith("d_id_")]
+    db.execute_query(
+        "UPDATE episode SET " + ", ".join(assignments) +
+        " WHERE id IN (" + ", ".join("%(" + k + ")s" for k in ids) + ")",
+        args, "none"
+    )
+
+
+def find_duplicates_batch(batch_size: int = DEDUPE_BATCH_SIZE, workers: Optional[int] = None):
+    """Batch version of find_duplicates: hashes local files across cores and resolves each batch with one
+    lookup and one UPDATE."""
+    last_key = {"air_date": "1900-01-01", "id": 0}
+    totals = {"originals": 0, "duplicates": 0, "missing": 0}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while True:
+            episodes = db.execute_query(
+                '''SELECT e.id, e.air_date, e.local_storage
+                FROM episode AS e
+                WHERE e.local_storage IS NOT NULL AND
+                 e.duplicate_of IS NULL AND
+                 e.content_hash IS NULL AND
+                 (e.air_date, e.id) > (%(air_date)s, %(id)s)
+                ORDER BY e.air_date, e.id
+                LIMIT %(batch_size)s
+                ''',
+                dict(last_key, batch_size=batch_size), "rows"
+            )
+            if not episodes:
+                break
+            last_key = {"air_date": str(episodes[-1]["air_date"]), "id": episodes[-1]["id"]}
+            file_names = [json.loads(e["local_storage"])[0] for e in episodes]
+            hashed = []
+            for e, episode_hash in zip(episodes, executor.map(hash_episode_file, file_names, chunksize=8)):
+                if episode_hash is None:
+                    totals["missing"] += 1
+                else:
+                    hashed.append((e["id"], episode_hash))
+            originals, duplicates = resolve_duplicates(hashed) if hashed else ({}, {})
+            store_dedupe_results(originals, duplicates)
+            totals["originals"] += len(originals)
+            totals["duplicates"] += len(duplicates)
+            print("dedupe progress: " + str(totals["originals"]) + " originals, " + str(totals["duplicates"]) +
+                  " duplicates, " + str(totals["missing"]) + " missing files")
+    return totals
@@ -1,24 +1,34 @@
-import urllib
-import urllib.request
+import hashlib
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional
 
+import requests
 from fake_useragent import UserAgent
 from root_anchor import ROOT_DIR
+from services.file_hash_generator import ContentHasher, gen_hash
 from utils import db
 
 ua = UserAgent()
 
 
-def download_remaining_glz_episodes():
-    return db.execute_query(
-        '''SELECT e.*
-           FROM episode AS e
-           WHERE e.channel_id = 0
+GLZ_REMAINING_EPISODES_CONDITION = '''e.channel_id = 0
              AND e.local_storage IS NULL
              AND e.air_date > '2023-10-06'
              AND e.download_status <> 'error'
              AND e.duplicate_of IS NULL
-             AND e.transcripts IS NULL
+             AND e.has_transcript = 0
              AND e.page_url NOT LIKE '%|%D7|%92|%D7|%9C|%D7|%92|%D7|%9C|%D7|%A6%' ESCAPE '|'
+'''
+
+
+def download_remaining_glz_episodes():
+    return db.execute_query(
+        '''SELECT e.*
+           FROM episode AS e
+           WHERE ''' + GLZ_REMAINING_EPISODES_CONDITION + '''
            ORDER BY e.air_date
            LIMIT 1
         ''',
@@ -26,11 +36,148 @@ def download_remaining_glz_episodes():
     )
 
 
-def download_glz_mp3_file(download_url: str, filename: str, file_ext: str = "mp3"):
+GLZ_CHUNK_SIZE = 1 << 16
+GLZ_DOWNLOAD_RETRIES = 5
+GLZ_RETRY_BACKOFF = 2.0
+GLZ_DOWNLOAD_TIMEOUT = 60
+# files larger than GLZ_PARALLEL_MIN_SIZE are fetched as GLZ_PARALLEL_PARTS concurrent byte ranges
+GLZ_PARALLEL_PARTS = int(os.getenv("GLZ_PARALLEL_PARTS", 1))
+GLZ_PARALLEL_MIN_SIZE = 32 * 1024 * 1024
+FINGERPRINT_SAMPLE_SIZE = 64 * 1024
+
+
+def glz_session() -> requests.Session:
+    session = requests.Session()
+    session.headers.update({"User-Agent": ua.chrome})
+    return session
+
+
+def probe_remote_file(session: requests.Session, download_url: str) -> tuple[Optional[int], bool]:
+    try:
+        response = session.head(download_url, allow_redirects=True, timeout=GLZ_DOWNLOAD_TIMEOUT)
+        response.raise_for_status()
+    except requests.RequestException:
+        return None, False
+    size = response.headers.get("Content-Length")
+    return (int(size) if size else None), response.headers.get("Accept-Ranges") == "bytes"
+
+
+def fetch_sample(session: requests.Session, download_url: str, byte_range: str, max_bytes: int) -> Optional[bytes]:
+    # streamed and cut at max_bytes, so a server that ignores Range never makes us download the whole file
+    with session.get(download_url, headers={"Range": "bytes=" + byte_range}, timeout=GLZ_DOWNLOAD_TIMEOUT,
+                     stream=True) as response:
+        if response.status_code != 206:
+            return None
+        sample = b""
+        for chunk in response.iter_content(chunk_size=min(max_bytes, 64 * 1024)):
+            sample += chunk
+            if len(sample) >= max_bytes:
+                break
+        return sample[:max_bytes]
+
+
+def remote_fingerprint(download_url: str) -> Optional[dict]:
+    """Cheap identity of a remote file: its size plus a hash of its first and last FINGERPRINT_SAMPLE_SIZE bytes,
+    fetched with two range requests instead of the whole file."""
+    with glz_session() as session:
+        try:
+            response = session.head(download_url, allow_redirects=True, timeout=GLZ_DOWNLOAD_TIMEOUT)
+            response.raise_for_status()
+            size = int(response.headers.get("Content-Length") or 0)
+            if not size or response.headers.get("Accept-Ranges") != "bytes":
+                return None
+            sample_size = min(FINGERPRINT_SAMPLE_SIZE, size)
+            head = fetch_sample(session, download_url, "0-" + str(sample_size - 1), sample_size)
+            tail = fetch_sample(session, download_url, "-" + str(sample_size), sample_size)
+        except requests.RequestException as e:
+            print("could not fingerprint " + download_url + ": " + str(e))
+            return None
+    if head is None or tail is None:
+        return None
+    sample_hash = hashlib.blake2b(head + tail, digest_size=16).hexdigest()
+    return {"fingerprint": str(size) + ":" + sample_hash, "etag": response.headers.get("ETag")}
+
+
+def fetch_range(session: requests.Session, download_url: str, path: Path, start: int = 0, end: Optional[int] = None,
+                hasher: Optional[ContentHasher] = None):
+    """Streams bytes start..end (inclusive, or to EOF when end is None) of the remote file into path at the
+    same offsets, resuming from the last written byte after a network error. A hasher that already holds
+    bytes 0..start is fed the rest of the stream in order."""
+    position = start
+    for attempt in range(GLZ_DOWNLOAD_RETRIES + 1):
+        headers = {}
+        if position > 0 or end is not None:
+            headers["Range"] = "bytes=" + str(position) + "-" + ("" if end is None else str(end))
+        try:
+            with session.get(download_url, headers=headers, stream=True, timeout=GLZ_DOWNLOAD_TIMEOUT) as response:
+                response.raise_for_status()
+                with open(path, "r+b") as f:
+                    if headers and response.status_code != 206:
+                        if end is not None:
+                            raise IOError("server does not support range requests")
+                        # range ignored, the full file is coming again
+                        position = 0
+                        f.truncate(0)
+                        if hasher is not None:
+                            hasher.reset()
+                    f.seek(position)
+                    for chunk in response.iter_content(GLZ_CHUNK_SIZE):
+                        f.write(chunk)
+                        if hasher is not None:
+                            hasher.update(chunk)
+                        position += len(chunk)
+            if end is None or position > end:
+                return
+        except requests.RequestException as e:
+            if attempt == GLZ_DOWNLOAD_RETRIES:
+                raise
+            print("download interrupted at byte " + str(position) + ", resuming: " + str(e))
+            time.sleep(GLZ_RETRY_BACKOFF * 2 ** attempt)
+    raise IOError("download incomplete after " + str(GLZ_DOWNLOAD_RETRIES) + " retries")
+
+
+def fetch_parallel_ranges(session: requests.Session, download_url: str, path: Path, size: int, parts: int):
+    with open(path, "wb") as f:
+        f.truncate(size)
+    part_size = -(-size // parts)
+    ranges = [(start, min(start + part_size, size) - 1) for start in range(0, size, part_size)]
+    with ThreadPoolExecutor(max_workers=parts) as executor:
+        for future in [executor.submit(fetch_range, session, download_url, path, start, end) for start, end in ranges]:
+            future.result()
+
+
+def download_glz_mp3_file(download_url: str, filename: str, file_ext: str = "mp3") -> str:
+    """Downloads the episode file and returns its content hash, computed while the bytes arrive."""
     print("downloading " + filename)
     print("from: " + download_url)
-    response = urllib.request.urlopen(urllib.request.Request(download_url, headers={'User-Agent': ua.chrome}))
-    content = response.read()
-    with open(ROOT_DIR / "dir" / filename + "." + file_ext, "wb") as file:
-        file.write(content)
-        print("done_downloading " + filename)
\ No newline at end of file
+    file_path = ROOT_DIR / "dir" / (filename + "." + file_ext)
+    part_path = ROOT_DIR / "dir" / (filename + "." + file_ext + ".part")
+    parallel_part_path = ROOT_DIR / "dir" / (filename + "." + file_ext + ".ranges")
+    with glz_session() as session:
+        size, accepts_ranges = probe_remote_file(session, download_url)
+        if GLZ_PARALLEL_PARTS > 1 and accepts_ranges and size and size >= GLZ_PARALLEL_MIN_SIZE:
+            # a preallocated file has no reliable resume point, so parallel downloads start over if interrupted
+            fetch_parallel_ranges(session, download_url, parallel_part_path, size, GLZ_PARALLEL_PARTS)
+            os.replace(parallel_part_path, file_path)
+            # ranges land out of order, so this is the one path that hashes after the fact
+            content_hash = gen_hash(file_path)
+        else:
+            if parallel_part_path.exists():
+                parallel_part_path.unlink()
+            # resume from whatever a previous attempt left in the .part file
+            part_path.touch()
+            resume_from = part_path.stat().st_size
+            if size is not None and resume_from > size:
+                part_path.write_bytes(b"")
+                resume_from = 0
+            hasher = ContentHasher()
+            if resume_from:
+                print("resuming download from byte " + str(resume_from))
+                hasher.update_from_file(part_path)
+            if size is None or resume_from < size:
+                fetch_range(session, download_url, part_path, resume_from, size - 1 if size and accepts_ranges else None,
+                            hasher)
+            os.replace(part_path, file_path)
+            content_hash = hasher.hexdigest()
+    print("done_downloading " + filename)
+    return content_hash
@@ -1,7 +1,14 @@
 import json
+import os
+import queue
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from datetime import datetime
-from time import sleep
-from urllib.parse import urljoin
+from typing import Optional
+from urllib.parse import urljoin, urlparse
 from w3lib.url import safe_url_string
 from incapsula import IncapSession
 from fake_useragent import UserAgent
@@ -11,57 +18,171 @@ from utils import db
 ua = UserAgent()
 user_agent = ua.chrome
 
+POST_LATEST_URL = "https://glz.co.il/umbraco/api/programme/PostLatest"
+# programmes crawled at the same time, and the Incapsula sessions they share
+GLZ_CRAWL_WORKERS = int(os.getenv("GLZ_CRAWL_WORKERS", 6))
+GLZ_CRAWL_SESSIONS = int(os.getenv("GLZ_CRAWL_SESSIONS", 3))
+# requests per second sent to one host across all workers, so a full refresh stays under Incapsula's radar
+GLZ_REQUESTS_PER_SECOND = float(os.getenv("GLZ_REQUESTS_PER_SECOND", 5))
+# attempts per page, waiting RETRY_BASE_SECONDS * 2^attempt (capped, with jitter) between them
+MAX_PAGE_ATTEMPTS = 5
+RETRY_BASE_SECONDS = 2
+RETRY_MAX_SECONDS = 60
+REQUEST_TIMEOUT = 30
+# responses that mean we are being throttled or challenged, answered by backing off on a fresh session
+BLOCKED_STATUS_CODES = {403, 429, 503}
+
+
+class BlockedResponse(Exception):
+    def __init__(self, status_code: int, retry_after: Optional[float] = None):
+        super().__init__("blocked with HTTP " + str(status_code))
+        self.retry_after = retry_after
+
+
+class PageFetchFailed(Exception):
+    pass
+
+
+class HostRateLimiter:
+    """Spaces requests to the same host at least 1 / requests_per_second apart, across all threads."""
+
+    def __init__(self, requests_per_second: float = GLZ_REQUESTS_PER_SECOND):
+        self.interval = 1 / requests_per_second
+        self._next_slot = {}
+        self._lock = threading.Lock()
+
+    def wait(self, url: str):
+        host = urlparse(url).netloc
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot.get(host, now))
+            self._next_slot[host] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+    def pause(self, url: str, seconds: float):
+        """Holds back every request to the host, e.g. after a 429, instead of only the one that got it."""
+        host = urlparse(url).netloc
+        with self._lock:
+            self._next_slot[host] = max(self._next_slot.get(host, 0), time.monotonic() + seconds)
+
+
+class SessionPool:
+    """A fixed set of IncapSessions shared by all crawl threads, so the Incapsula cookies are solved once per
+    session rather than once per programme. A session that gets blocked is replaced by a new one."""
+
+    def __init__(self, size: int = GLZ_CRAWL_SESSIONS):
+        self._sessions = queue.LifoQueue()
+        for _ in range(size):
+            self._sessions.put(None)
+
+    @contextmanager
+    def session(self):
+        session = self._sessions.get()
+        if session is None:
+            session = IncapSession(user_agent=user_agent)
+        try:
+            yield session
+        except BlockedResponse:
+            session.close()
+            session = None
+            raise
+        finally:
+            self._sessions.put(session)
+
+
+rate_limiter = HostRateLimiter()
+session_pool = SessionPool()
+# fetches of the next PostLatest page, kept apart from the programme workers so a worker waiting on its
+# prefetch never waits for a slot held by another waiting worker
+_prefetch_executor = ThreadPoolExecutor(max_workers=GLZ_CRAWL_WORKERS, thread_name_prefix="glz-prefetch")
+
+
+def retry_delay(attempt: int) -> float:
+    return min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** attempt) * random.uniform(0.5, 1)
+
+
+def fetch_page(programme_id: int, page: int) -> dict:
+    for attempt in range(MAX_PAGE_ATTEMPTS):
+        try:
+            rate_limiter.wait(POST_LATEST_URL)
+            with session_pool.session() as session:
+                response = session.post(
+                    POST_LATEST_URL,
+                    data={"page": page, "ProgrammeId": programme_id},
+                    timeout=REQUEST_TIMEOUT,
+                )
+                if response.status_code in BLOCKED_STATUS_CODES:
+                    retry_after = response.headers.get("Retry-After")
+                    raise BlockedResponse(response.status_code, float(retry_after) if retry_after and retry_after.isdigit() else None)
+                response.raise_for_status()
+                return response.json()
+        except BlockedResponse as e:
+            # the host-wide pause is the only wait, the next rate_limiter.wait() sits it out
+            delay = min(e.retry_after or retry_delay(attempt + 1), RETRY_MAX_SECONDS)
+            rate_limiter.pause(POST_LATEST_URL, delay)
+            print("programme " + str(programme_id) + " page " + str(page) + ": " + str(e) + ", backing off " + str(round(delay)) + "s")
+        except Exception as e:
+            delay = retry_delay(attempt)
+            print("programme " + str(programme_id) + " page " + str(page) + ": " + str(e) + ", retrying in " + str(round(delay)) + "s")
+            if attempt + 1 < MAX_PAGE_ATTEMPTS:
+                time.sleep(delay)
+    raise PageFetchFailed("programme " + str(programme_id) + " page " + str(page) + " failed " + str(MAX_PAGE_ATTEMPTS) + " times")
+
+
+def parse_episode(programme_id: int, ep: dict) -> dict:
+    ep_date_parts = ep["date"].split(".")
+    try:
+        ep_runtime = int(ep["totalTime"].split(":")[0])
+    except Exception as e:
+        ep_runtime = 0
+    return {
+        "programme_id": programme_id,
+        "glz_id": ep["id"],
+        "file_url": ep["fileUrl"],
+        "page_url": safe_url_string(urljoin("https://glz.co.il/", ep["url"])),
+        "air_date": datetime(int("20" + ep_date_parts[2]), int(ep_date_parts[1]), int(ep_date_parts[0])),
+        "runtime": ep_runtime,
+        "data": json.dumps(ep)
+    }
+
 
 def extract_programme_episodes(programme_id: int, from_date: datetime, to_date: datetime):
+    """Pages PostLatest, newest first, until it passes from_date; page N+1 is requested while page N is parsed.
+    A page that still fails after MAX_PAGE_ATTEMPTS ends the walk with the episodes found so far."""
     ep_dict = dict()
-    session = IncapSession(user_agent=user_agent)
     page = 0
-    err_count = 0
-    while True:
+    next_page = _prefetch_executor.submit(fetch_page, programme_id, page)
+    while next_page is not None:
         try:
-            url = "https://glz.co.il/umbraco/api/programme/PostLatest"
-            response = session.post(
-                url,
-                data={"page": page, "ProgrammeId": programme_id},
-            )
-            res_json = response.json()
-            if res_json["totalPages"] < page:
-                break
-            episode_batch = res_json["results"]
-            if len(episode_batch) == 0:
-                break
-            out_of_date_range = False
-            for ep in episode_batch:
-                ep_id = ep["id"]
-                ep_file_url = ep["fileUrl"]
-                ep_url = safe_url_string(urljoin("https://glz.co.il/", ep["url"]))
-                ep_date_parts = ep["date"].split(".")
-                ep_date = datetime(int("20" + ep_date_parts[2]), int(ep_date_parts[1]), int(ep_date_parts[0]))
-                try:
-                    ep_runtime = int(ep["totalTime"].split(":")[0])
-                except Exception as e:
-                    ep_runtime = 0
-                ep_obj = {
-                    "programme_id": programme_id,
-                    "glz_id": ep_id,
-                    "file_url": ep_file_url,
-                    "page_url": ep_url,
-                    "air_date": ep_date,
-                    "runtime": ep_runtime,
-                    "data": json.dumps(ep)
-                }
-                if ep_date < from_date:
-                    out_of_date_range = True
-                elif ep_date <= to_date:
-                    ep_dict[ep_id] = ep_obj
-            if out_of_date_range:
-                break
-        except Exception as e:
-            err_count += 1
+            res_json = next_page.result()
+        except PageFetchFailed as e:
             print(e)
-        page += 1
-        if err_count > 3:
             break
+        next_page = None
+        if res_json["totalPages"] < page:
+            break
+        episode_batch = res_json["results"]
+        if len(episode_batch) == 0:
+            break
+        if page + 1 <= res_json["totalPages"]:
+            next_page = _prefetch_executor.submit(fetch_page, programme_id, page + 1)
+        out_of_date_range = False
+        for ep in episode_batch:
+            try:
+                ep_obj = parse_episode(programme_id, ep)
+            except Exception as e:
+                print(e)
+                continue
+            if ep_obj["air_date"] < from_date:
+                out_of_date_range = True
+            elif ep_obj["air_date"] <= to_date:
+                ep_dict[ep_obj["glz_id"]] = ep_obj
+        if out_of_date_range:
+            if next_page is not None:
+                next_page.cancel()
+            break
+        page += 1
     episodes = list(ep_dict.values())
     return episodes
 
@@ -107,11 +228,24 @@ def get_shows():
     )
 
 
+def crawl_programme(programme: dict, from_date: datetime, to_date: datetime) -> int:
+    episodes = extract_programme_episodes(programme["glz_id"], from_date, to_date)
+    saved_count = store_episode(episodes)
+    print(programme["title"] + ": found " + str(len(episodes)) + " episodes, stored " + str(saved_count))
+    return saved_count
+
+
 def extract_episodes_for_all_shows(from_date: datetime, to_date: datetime):
+    """Crawls GLZ_CRAWL_WORKERS programmes at a time; all of them share the session pool and the per-host rate limit."""
     shows = get_shows()
-    for programme in shows:
-        print("searching episodes from " + programme["title"])
-        episodes = extract_programme_episodes(programme["glz_id"], from_date, to_date)
-        print("found " + str(len(episodes)) + " episodes")
-        saved_count = store_episode(episodes)
-        print("stored " + str(saved_count) + " episodes")
+    print("searching episodes from " + str(len(shows)) + " programmes")
+    saved_total = 0
+    with ThreadPoolExecutor(max_workers=GLZ_CRAWL_WORKERS, thread_name_prefix="glz-crawl") as executor:
+        futures = {executor.submit(crawl_programme, programme, from_date, to_date): programme for programme in shows}
+        for f in as_completed(futures):
+            try:
+                saved_total += f.result()
+            except Exception as e:
+                print(futures[f]["title"] + ": " + str(e))
+    print("stored " + str(saved_total) + " episodes")
+    return saved_total
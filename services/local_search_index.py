@@ -0,0 +1,404 @@
+import bisect
+import heapq
+import json
+import mmap
+import os
+import re
+import shutil
+import threading
+from array import array
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterable, Literal, Optional
+
+from dotenv import load_dotenv
+
+from root_anchor import ROOT_DIR
+from services.transcript_segment_indexer import prefix_variants, strip_niqqud
+from utils import db
+from services.transcript_store import load_episodes_transcripts
+from utils.transcripts import iter_transcript_results, result_text
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+load_dotenv()
+# "mysql" searches the episode table directly, "local" answers contains/boolean searches from the on-disk index
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "mysql")
+LOCAL_INDEX_DIR = Path(os.getenv("LOCAL_INDEX_DIR") or ROOT_DIR / "index")
+MAX_GENERATIONS = 32
+
+# every posting is (episode_id, part, segment, word position) stored as 4 uint32
+POSTING_WIDTH = 4
+WORD = re.compile(r'\w+')
+# how a query word is compared with the indexed words: contains searches match inside words, like the
+# LIKE '%...%' of the MySQL backend, boolean searches match whole words or, with a trailing *, prefixes
+TERM_MATCH = Literal["exact", "prefix", "suffix", "substring"]
+QUERY_TOKEN = re.compile(r'"([^"]*)"(?:@(\d+))?|([+\-~<>()])|([^\s+\-~<>()"]+)')
+
+
+def tokenize(text: str) -> list[str]:
+    return WORD.findall(strip_niqqud(text).lower())
+
+
+def collect_postings(episodes: dict[int, list]) -> dict[str, list[tuple]]:
+    postings = {}
+    for episode_id in sorted(episodes):
+        for part, segment, result in iter_transcript_results(episodes[episode_id]):
+            for position, word in enumerate(tokenize(result_text(result))):
+                for term in prefix_variants(word):
+                    postings.setdefault(term, []).append((episode_id, part, segment, position))
+    return postings
+
+
+def write_generation(path: Path, postings: Iterable[tuple[str, list[tuple]]]):
+    """Writes (term, postings) pairs, given in term order, streaming the postings to disk as they come."""
+    terms = []
+    offsets = []
+    lengths = []
+    tmp_path = path.with_name(path.name + ".tmp")
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    written = 0
+    with open(tmp_path / "postings.bin", "wb") as f:
+        for term, term_postings in postings:
+            terms.append(term)
+            offsets.append(written)
+            lengths.append(len(term_postings))
+            data = array('I')
+            for posting in term_postings:
+                data.extend(posting)
+            data.tofile(f)
+            written += len(term_postings)
+    with open(tmp_path / "terms.json", "w", encoding="utf8") as f:
+        json.dump({"terms": terms, "offsets": offsets, "lengths": lengths}, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+class IndexGeneration:
+    """One immutable batch of postings; the postings file is memory-mapped and read on demand."""
+
+    def __init__(self, path: Path):
+        self.name = path.name
+        with open(path / "terms.json", encoding="utf8") as f:
+            terms = json.load(f)
+        self.terms = terms["terms"]
+        self.offsets = terms["offsets"]
+        self.lengths = terms["lengths"]
+        self._file = open(path / "postings.bin", "rb")
+        self._map = None
+        self._postings = memoryview(array('I'))
+        if os.fstat(self._file.fileno()).st_size:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._postings = memoryview(self._map).cast('I')
+
+    def matching_terms(self, term: str, match: TERM_MATCH = "exact") -> list[int]:
+        if match == "suffix":
+            return [i for i, t in enumerate(self.terms) if t.endswith(term)]
+        if match == "substring":
+            return [i for i, t in enumerate(self.terms) if term in t]
+        i = bisect.bisect_left(self.terms, term)
+        if match == "exact":
+            return [i] if i < len(self.terms) and self.terms[i] == term else []
+        matches = []
+        while i < len(self.terms) and self.terms[i].startswith(term):
+            matches.append(i)
+            i += 1
+        return matches
+
+    def lookup(self, term: str, match: TERM_MATCH = "exact") -> list[tuple]:
+        postings = []
+        for i in self.matching_terms(term, match):
+            start = self.offsets[i] * POSTING_WIDTH
+            chunk = self._postings[start:start + self.lengths[i] * POSTING_WIDTH].tolist()
+            postings.extend(zip(*[iter(chunk)] * POSTING_WIDTH))
+        return postings
+
+    def close(self):
+        self._postings.release()
+        if self._map is not None:
+            self._map.close()
+        self._file.close()
+
+
+class Term:
+    def __init__(self, text: str, match: TERM_MATCH = "exact"):
+        self.text = text
+        self.match = match
+
+
+class Phrase:
+    def __init__(self, words: list[Term], distance: Optional[int] = None):
+        self.words = words
+        self.distance = distance
+
+
+class Group:
+    def __init__(self, clauses: list[tuple[str, object]]):
+        self.clauses = clauses
+
+
+def parse_boolean_query(query: str) -> Group:
+    """Parses MySQL BOOLEAN MODE syntax: + - ~ < > operators, (groups), "phrases", "proximity"@N and prefix*."""
+    tokens = QUERY_TOKEN.findall(query)
+    position = 0
+
+    def parse_group() -> Group:
+        nonlocal position
+        clauses = []
+        operator = ""
+        while position < len(tokens):
+            phrase, distance, symbol, word = tokens[position]
+            position += 1
+            if symbol == ")":
+                break
+            if symbol == "(":
+                clauses.append((operator, parse_group()))
+                operator = ""
+            elif symbol:
+                operator = symbol
+            elif word:
+                for sub_word in tokenize(word):
+                    clauses.append((operator, Term(sub_word, "prefix" if word.endswith("*") else "exact")))
+                operator = ""
+            else:
+                words = tokenize(phrase)
+                if words:
+                    clauses.append((operator, Phrase([Term(w) for w in words], int(distance) if distance else None)))
+                operator = ""
+        return Group(clauses)
+
+    return parse_group()
+
+
+def contains_query(query: str):
+    """Substring search like LIKE '%query%', except that words are compared without the punctuation between
+    them: a single word matches inside any word, a phrase has to start at the end of a word and end at the start
+    of one, with the words in between matching whole."""
+    words = tokenize(query)
+    if not words:
+        return Group([])
+    if len(words) == 1:
+        return Group([("+", Term(words[0], "substring"))])
+    return Group([("+", Phrase([Term(words[0], "suffix")] + [Term(w) for w in words[1:-1]] + [Term(words[-1], "prefix")]))])
+
+
+class LocalSearchIndex:
+    def __init__(self, index_dir: Path = LOCAL_INDEX_DIR):
+        self.index_dir = Path(index_dir)
+        self.manifest = {"next_generation": 0, "generations": [], "episodes": {}}
+        self._manifest_mtime = None
+        self._generations: dict[str, IndexGeneration] = {}
+        self._lock = threading.RLock()
+        self._manifest_lock_depth = 0
+
+    @property
+    def manifest_path(self) -> Path:
+        return self.index_dir / "manifest.json"
+
+    @contextmanager
+    def _writing(self):
+        """Serializes read-modify-replace of manifest.json across threads and, through a lock file, across the
+        server and pipeline processes; reentrant, so compact() can run inside add_episodes()."""
+        with self._lock:
+            lock_file = None
+            if not self._manifest_lock_depth:
+                os.makedirs(self.index_dir, exist_ok=True)
+                if fcntl is not None:
+                    lock_file = open(self.index_dir / "manifest.lock", "a")
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                # always re-read, another process may have replaced the manifest within the same mtime tick
+                self._manifest_mtime = None
+                self.refresh()
+            self._manifest_lock_depth += 1
+            try:
+                yield
+            finally:
+                self._manifest_lock_depth -= 1
+                if lock_file is not None:
+                    # closing the file releases the flock
+                    lock_file.close()
+
+    def refresh(self):
+        with self._lock:
+            try:
+                mtime = os.stat(self.manifest_path).st_mtime_ns
+            except FileNotFoundError:
+                return
+            if mtime == self._manifest_mtime:
+                return
+            with open(self.manifest_path, encoding="utf8") as f:
+                self.manifest = json.load(f)
+            self._manifest_mtime = mtime
+            for name in list(self._generations):
+                if name not in self.manifest["generations"]:
+                    self._generations.pop(name).close()
+            for name in self.manifest["generations"]:
+                if name not in self._generations:
+                    self._generations[name] = IndexGeneration(self.index_dir / name)
+
+    def _save_manifest(self):
+        os.makedirs(self.index_dir, exist_ok=True)
+        tmp_path = self.manifest_path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf8") as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp_path, self.manifest_path)
+        self.refresh()
+
+    def _new_generation_name(self) -> str:
+        name = "gen_" + str(self.manifest["next_generation"]).zfill(6)
+        self.manifest["next_generation"] += 1
+        return name
+
+    def add_episodes(self, episodes: list[dict]):
+        """Indexes episodes given as {id, air_date, transcripts}; re-adding an episode replaces its postings."""
+        if not episodes:
+            return
+        with self._writing():
+            name = self._new_generation_name()
+            postings = collect_postings({e["id"]: e["transcripts"] for e in episodes})
+            write_generation(self.index_dir / name, ((term, postings[term]) for term in sorted(postings)))
+            self.manifest["generations"].append(name)
+            for e in episodes:
+                self.manifest["episodes"][str(e["id"])] = {"air_date": str(e["air_date"]), "generation": name}
+            self._save_manifest()
+            if len(self.manifest["generations"]) > MAX_GENERATIONS:
+                self.compact()
+
+    def remove_episode(self, episode_id: int):
+        with self._writing():
+            if self.manifest["episodes"].pop(str(episode_id), None) is not None:
+                self._save_manifest()
+
+    def compact(self):
+        """Merges all generations into one, dropping postings of removed or re-indexed episodes. Terms are merged
+        in order across the generations and written one at a time, so only one term's postings are in memory."""
+        with self._writing():
+            old_generations = list(self.manifest["generations"])
+
+            def live_postings():
+                previous = None
+                for term in heapq.merge(*[self._generations[name].terms for name in old_generations]):
+                    if term == previous:
+                        continue
+                    previous = term
+                    live = self._lookup(term)
+                    if live:
+                        yield term, sorted(live)
+
+            name = self._new_generation_name()
+            write_generation(self.index_dir / name, live_postings())
+            for e in self.manifest["episodes"].values():
+                e["generation"] = name
+            self.manifest["generations"] = [name]
+            self._save_manifest()
+            for old_name in old_generations:
+                shutil.rmtree(self.index_dir / old_name, ignore_errors=True)
+
+    def _lookup(self, term: str, match: TERM_MATCH = "exact") -> list[tuple]:
+        episodes = self.manifest["episodes"]
+        postings = []
+        for name, generation in self._generations.items():
+            postings.extend(
+                p for p in generation.lookup(term, match)
+                if episodes.get(str(p[0]), {}).get("generation") == name
+            )
+        return postings
+
+    def _phrase_episodes(self, phrase: Phrase) -> set[int]:
+        if not phrase.words:
+            return set()
+        # positions of every word, grouped by (episode_id, part, segment)
+        word_positions = []
+        for word in phrase.words:
+            positions = {}
+            for episode_id, part, segment, position in self._lookup(word.text, word.match):
+                positions.setdefault((episode_id, part, segment), set()).add(position)
+            word_positions.append(positions)
+        matches = set()
+        for key in set.intersection(*[set(p) for p in word_positions]):
+            for anchor in word_positions[0][key]:
+                if phrase.distance is None:
+                    found = all(anchor + i in word_positions[i][key] for i in range(1, len(phrase.words)))
+                else:
+                    found = all(
+                        any(abs(p - anchor) <= phrase.distance for p in word_positions[i][key])
+                        for i in range(1, len(phrase.words))
+                    )
+                if found:
+                    matches.add(key[0])
+                    break
+        return matches
+
+    def _evaluate(self, node) -> set[int]:
+        if isinstance(node, Term):
+            return {p[0] for p in self._lookup(node.text, node.match)}
+        if isinstance(node, Phrase):
+            return self._phrase_episodes(node)
+        required = [self._evaluate(n) for op, n in node.clauses if op == "+"]
+        excluded = [self._evaluate(n) for op, n in node.clauses if op == "-"]
+        if required:
+            matches = set.intersection(*required)
+        else:
+            matches = set().union(*[self._evaluate(n) for op, n in node.clauses if op not in ("+", "-")])
+        return matches.difference(*excluded)
+
+    def search(self, search_type: str, query: str) -> list[tuple[str, int]]:
+        """Returns the matching episodes as (air_date, episode_id), in (air_date, id) order."""
+        if not query:
+            return []
+        node = parse_boolean_query(query) if search_type == "boolean" else contains_query(query)
+        with self._lock:
+            self.refresh()
+            episodes = self.manifest["episodes"]
+            return sorted((episodes[str(e)]["air_date"], e) for e in self._evaluate(node))
+
+
+local_index = LocalSearchIndex()
+
+
+def add_episode_to_local_index(episode_id: int, parts: list):
+    episode = db.execute_query(
+        '''SELECT e.id, e.air_date FROM episode AS e WHERE e.id = %(id)s''',
+        {"id": episode_id}, "single_row"
+    )
+    if not episode:
+        return
+    local_index.add_episodes([{"id": episode_id, "air_date": episode["air_date"], "transcripts": parts}])
+
+
+BUILD_BATCH_SIZE = 200
+
+
+def build_local_index():
+    last_id = 0
+    indexed_count = 0
+    while True:
+        episodes = db.execute_query(
+            '''SELECT e.id, e.air_date
+            FROM episode AS e
+            WHERE e.id > %(last_id)s
+             AND e.has_transcript = 1
+             AND e.duplicate_of IS NULL
+            ORDER BY e.id
+            LIMIT %(batch_size)s
+            ''',
+            {"last_id": last_id, "batch_size": BUILD_BATCH_SIZE}, "rows"
+        )
+        if not episodes:
+            break
+        last_id = episodes[-1]["id"]
+        transcripts = load_episodes_transcripts([e["id"] for e in episodes])
+        for e in episodes:
+            e["transcripts"] = transcripts.get(e["id"], [])
+        local_index.add_episodes(episodes)
+        indexed_count += len(episodes)
+        print("indexed " + str(indexed_count) + " episodes")
+    local_index.compact()
+    return indexed_count
+
+
+if __name__ == "__main__":
+    build_local_index()
@@ -0,0 +1,80 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from datetime import timedelta
+from typing import Optional
+
+try:
+    from faster_whisper import WhisperModel
+except ImportError:
+    WhisperModel = None
+try:
+    from faster_whisper import BatchedInferencePipeline
+except ImportError:
+    BatchedInferencePipeline = None
+
+# a CTranslate2 Whisper model name or directory, quantized to int8 so it runs at a usable speed on CPU
+WHISPER_MODEL = os.getenv("WHISPER_MODEL", "large-v3-turbo")
+WHISPER_COMPUTE_TYPE = os.getenv("WHISPER_COMPUTE_TYPE", "int8")
+WHISPER_LANGUAGE = "he"
+# every worker process runs one model on WHISPER_THREADS cores, so the pool covers the whole machine
+WHISPER_THREADS = int(os.getenv("WHISPER_THREADS", 4))
+WHISPER_PROCESSES = int(os.getenv("WHISPER_PROCESSES", max(1, (os.cpu_count() or 1) // WHISPER_THREADS)))
+# speech chunks cut by the VAD that are decoded together in one batch
+WHISPER_BATCH_SIZE = int(os.getenv("WHISPER_BATCH_SIZE", 8))
+
+_model = None
+
+
+def load_model():
+    global _model
+    if WhisperModel is None:
+        raise ImportError("faster-whisper is required for TRANSCRIBE_BACKEND=whisper")
+    model = WhisperModel(WHISPER_MODEL, device="cpu", compute_type=WHISPER_COMPUTE_TYPE, cpu_threads=WHISPER_THREADS)
+    _model = BatchedInferencePipeline(model=model) if BatchedInferencePipeline is not None else model
+
+
+def transcribe_local_file(file_path: str) -> list[dict]:
+    """Transcribes a local audio file into the same list[dict] structure the Speech-to-Text backend returns,
+    with each VAD speech chunk as one result ending at its offset."""
+    if _model is None:
+        load_model()
+    if BatchedInferencePipeline is not None:
+        segments, _ = _model.transcribe(file_path, language=WHISPER_LANGUAGE, batch_size=WHISPER_BATCH_SIZE)
+    else:
+        segments, _ = _model.transcribe(file_path, language=WHISPER_LANGUAGE, vad_filter=True)
+    return [{
+        "transcript": {
+            "results": [{
+                "offset": str(timedelta(seconds=s.end)),
+                "alternatives": [s.text.strip()]
+            } for s in segments],
+        }
+    }]
+
+
+class LocalTranscriber:
+    """Transcribes local files on a pool of WHISPER_PROCESSES processes, each holding its own loaded model.
+
+    submit() has the same contract as BatchTranscriber.submit, but takes the path of the local file instead
+    of the GCS object name.
+    """
+    remote = False
+
+    def __init__(self, processes: int = WHISPER_PROCESSES):
+        self.processes = processes
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    def submit(self, file_path: str, audio_format: Optional[str] = None) -> Future:
+        # stage threads submit concurrently, and every extra pool would load the model in each of its workers
+        with self._executor_lock:
+            if self._executor is None:
+                # spawned, forking a process already running stage, DB and upload threads can deadlock the child
+                self._executor = ProcessPoolExecutor(max_workers=self.processes, initializer=load_model,
+                                                     mp_context=multiprocessing.get_context("spawn"))
+        return self._executor.submit(transcribe_local_file, str(file_path))
+
+
+local_transcriber = LocalTranscriber()
@@ -0,0 +1,74 @@
+import re
+from typing import Literal, Optional
+
+from utils.transcripts import iter_transcript_results, load_transcripts, result_text
+
+SEARCH_TYPE = Literal["contains", "regex", "boolean"]
+
+SNIPPET_CONTEXT_CHARS = 80
+MAX_HITS_PER_EPISODE = 50
+
+BOOLEAN_OPERATORS = re.compile(r'[+\-<>~()]')
+BOOLEAN_TERM = re.compile(r'"([^"]+)"|(\S+)')
+
+
+def compile_search_pattern(search_type: SEARCH_TYPE, query: str) -> Optional[re.Pattern]:
+    """Builds a python regex that locates the hits MySQL matched for the given search mode."""
+    if not query:
+        return None
+    if search_type == "contains":
+        return re.compile(re.escape(query), re.IGNORECASE)
+    if search_type == "regex":
+        try:
+            return re.compile(query, re.IGNORECASE)
+        except re.error:
+            return None
+    # boolean mode: keep the positive terms and phrases, honour the trailing * prefix operator
+    alternatives = []
+    for phrase, word in BOOLEAN_TERM.findall(query):
+        if word.startswith("-"):
+            continue
+        term = phrase or BOOLEAN_OPERATORS.sub("", word)
+        if not term or term == "*":
+            continue
+        if term.endswith("*"):
+            alternatives.append(re.escape(term[:-1]) + r"\w*")
+        else:
+            alternatives.append(re.escape(term))
+    if not alternatives:
+        return None
+    return re.compile("|".join(alternatives), re.IGNORECASE)
+
+
+def build_snippet(text: str, spans: list[tuple[int, int]], context: int = SNIPPET_CONTEXT_CHARS) -> dict:
+    start = max(spans[0][0] - context, 0)
+    end = min(spans[-1][1] + context, len(text))
+    prefix = "…" if start > 0 else ""
+    suffix = "…" if end < len(text) else ""
+    shift = len(prefix) - start
+    return {
+        "snippet": prefix + text[start:end] + suffix,
+        "matches": [[s + shift, e + shift] for s, e in spans],
+    }
+
+
+def extract_hits(transcripts: Optional[str], pattern: Optional[re.Pattern], max_hits: int = MAX_HITS_PER_EPISODE) -> list[dict]:
+    """Returns the transcript segments that contain a match, with a trimmed snippet around the matches."""
+    if not transcripts or pattern is None:
+        return []
+    hits = []
+    for part_index, segment_index, result in iter_transcript_results(load_transcripts(transcripts)):
+        text = result_text(result)
+        spans = [m.span() for m in pattern.finditer(text) if m.end() > m.start()]
+        if not spans:
+            continue
+        hit = {
+            "part": part_index,
+            "segment": segment_index,
+            "offset": result.get("offset"),
+        }
+        hit.update(build_snippet(text, spans))
+        hits.append(hit)
+        if len(hits) >= max_hits:
+            break
+    return hits
@@ -0,0 +1,240 @@
+import os
+import queue
+import socket
+import threading
+import time
+from typing import Callable, Optional
+
+from services.episode_downloader import REPORT_INTERVAL, SOURCE_TYPE, TRANSCRIBE_MODE, precheck_remote_duplicate, \
+    fetch_episode_file, deduplicate_episode_file, split_episode_file, prepare_segments, start_segment_uploads, \
+    transcribe_segments, submit_transcription_jobs, store_transcripts, set_episode_download_status, load_segment_offsets
+from services.episode_worker_pool import EPISODE_LEASE_SECONDS, claim_next_episode, renew_lease, release_lease
+from utils import db
+
+# (stage name, default concurrency): network stages get several threads, transcription waits on remote
+# operations so it gets the most, the ffmpeg/pydub split is CPU bound; sized so that every stage thread plus
+# the claim loop and the lease renewer fit in the default DB pool of 20 connections, raise DB_POOL_SIZE (up to 32)
+# to run more
+DEFAULT_STAGE_WORKERS = {
+    "precheck": 2,
+    "fetch": 3,
+    "dedupe": 1,
+    "split": min(os.cpu_count() or 2, 3),
+    "prepare": min(os.cpu_count() or 2, 2),
+    "upload": 2,
+    "transcribe": 4,
+    "store": 1,
+}
+# threads besides the stages that use a DB connection: the claim loop and the lease renewer
+PIPELINE_DB_THREADS = 2
+STAGE_QUEUE_SIZE = int(os.getenv("STAGE_QUEUE_SIZE", 4))
+
+STOP = object()
+
+
+class Stage:
+    def __init__(self, name: str, handler: Callable[[dict], bool], workers: int, queue_size: int = STAGE_QUEUE_SIZE):
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        # bounded, so a slow stage pushes back on the ones feeding it instead of piling up files on disk
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.next_stage: Optional["Stage"] = None
+        self.on_done: Callable[[dict], None] = lambda job: None
+        self.processed = 0
+        self.failed = 0
+        self.busy_seconds = 0.0
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=self.name + "-" + str(i), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        for _ in self._threads:
+            self.queue.put(STOP)
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self):
+        # nothing may escape this loop: a dead thread would leave its job in flight and run() waiting forever
+        while True:
+            job = self.queue.get()
+            if job is STOP:
+                return
+            start = time.time()
+            carry_on = False
+            try:
+                carry_on = self.handler(job)
+                with self._lock:
+                    self.processed += 1
+            except Exception as e:
+                with self._lock:
+                    self.failed += 1
+                print(self.name + " failed for episode " + str(job["episode"]["id"]) + ": " + str(e))
+                try:
+                    set_episode_download_status(job["episode"]["id"], "error", str(e)[0:300])
+                except Exception as status_error:
+                    print("could not mark episode " + str(job["episode"]["id"]) + " failed: " + str(status_error))
+            finally:
+                with self._lock:
+                    self.busy_seconds += time.time() - start
+            handed_on = False
+            try:
+                if carry_on and self.next_stage is not None:
+                    self.next_stage.queue.put(job)
+                    handed_on = True
+            finally:
+                if not handed_on:
+                    try:
+                        self.on_done(job)
+                    except Exception as e:
+                        print(self.name + " could not finish episode " + str(job["episode"]["id"]) + ": " + str(e))
+
+    def report(self, elapsed: float) -> str:
+        with self._lock:
+            per_hour = self.processed / elapsed * 3600 if elapsed else 0
+            utilization = self.busy_seconds / (elapsed * self.workers) if elapsed else 0
+            return (self.name + ": " + str(self.processed) + " done, " + str(self.failed) + " failed, " +
+                    str(self.queue.qsize()) + " queued, " + f"{per_hour:.1f}/h, {utilization:.0%} busy")
+
+
+def precheck_stage(job: dict) -> bool:
+    return not precheck_remote_duplicate(job["episode"], job["source_type"])
+
+
+def fetch_stage(job: dict) -> bool:
+    job["filename"], job["content_hash"], job["segments"] = fetch_episode_file(job["episode"], job["source_type"])
+    return True
+
+
+def dedupe_stage(job: dict) -> bool:
+    return not deduplicate_episode_file(job["episode"]["id"], job["filename"], job["content_hash"], job["segments"])
+
+
+def split_stage(job: dict) -> bool:
+    job["segments"] = split_episode_file(job["episode"]["id"], job["filename"], job["segments"])
+    set_episode_download_status(job["episode"]["id"], "downloaded")
+    return bool(job["segments"])
+
+
+def prepare_stage(job: dict) -> bool:
+    job["prepared"] = prepare_segments(job["segments"], load_segment_offsets(job["episode"]["id"]))
+    return True
+
+
+def upload_stage(job: dict) -> bool:
+    # only starts the uploads, so the stage moves on to the next episode while these are still in flight
+    job["uploads"] = start_segment_uploads(job["prepared"])
+    return True
+
+
+def transcribe_stage(job: dict) -> bool:
+    for upload in job["uploads"]:
+        upload.result()
+    if TRANSCRIBE_MODE == "async":
+        submit_transcription_jobs(job["episode"]["id"], job["prepared"])
+        return False
+    job["transcripts"] = transcribe_segments(job["prepared"])
+    return True
+
+
+def store_stage(job: dict) -> bool:
+    store_transcripts(job["episode"]["id"], job["transcripts"])
+    return True
+
+
+STAGE_HANDLERS = [
+    ("precheck", precheck_stage),
+    ("fetch", fetch_stage),
+    ("dedupe", dedupe_stage),
+    ("split", split_stage),
+    ("prepare", prepare_stage),
+    ("upload", upload_stage),
+    ("transcribe", transcribe_stage),
+    ("store", store_stage),
+]
+
+
+class StagedPipeline:
+    """Runs every episode through precheck -> fetch -> dedupe -> split -> prepare -> upload -> transcribe -> store, with each stage
+    working on a different episode at the same time."""
+
+    def __init__(self, source_type: SOURCE_TYPE, stage_workers: Optional[dict[str, int]] = None):
+        self.source_type = source_type
+        self.worker_id = socket.gethostname() + "-" + str(os.getpid()) + "-pipeline"
+        workers = dict(DEFAULT_STAGE_WORKERS, **(stage_workers or {}))
+        if sum(workers.values()) + PIPELINE_DB_THREADS > db.DB_POOL_SIZE:
+            raise ValueError("the pipeline needs " + str(sum(workers.values()) + PIPELINE_DB_THREADS) +
+                             " DB connections but DB_POOL_SIZE is " + str(db.DB_POOL_SIZE))
+        self.stages = [Stage(name, handler, workers[name]) for name, handler in STAGE_HANDLERS]
+        for stage, next_stage in zip(self.stages, self.stages[1:]):
+            stage.next_stage = next_stage
+        for stage in self.stages:
+            stage.on_done = self._finish
+        self.in_flight = set()
+        self._in_flight_changed = threading.Condition()
+        self._stopped = threading.Event()
+
+    def _finish(self, job: dict):
+        episode_id = job["episode"]["id"]
+        try:
+            release_lease(episode_id, self.worker_id)
+        finally:
+            with self._in_flight_changed:
+                self.in_flight.discard(episode_id)
+                self._in_flight_changed.notify_all()
+
+    def _renew_leases(self):
+        while not self._stopped.wait(EPISODE_LEASE_SECONDS / 3):
+            with self._in_flight_changed:
+                episode_ids = list(self.in_flight)
+            for episode_id in episode_ids:
+                renew_lease(episode_id, self.worker_id)
+
+    def _report_progress(self, start: float):
+        while not self._stopped.wait(REPORT_INTERVAL):
+            self.print_report(time.time() - start)
+
+    def print_report(self, elapsed: float):
+        print("**** PIPELINE REPORT after " + str(int(elapsed)) + " seconds, " +
+              str(len(self.in_flight)) + " episodes in flight ****")
+        for stage in self.stages:
+            print("  " + stage.report(elapsed))
+
+    def run(self):
+        start = time.time()
+        for stage in self.stages:
+            stage.start()
+        threading.Thread(target=self._renew_leases, daemon=True).start()
+        threading.Thread(target=self._report_progress, args=(start,), daemon=True).start()
+        while True:
+            episode_id = claim_next_episode(self.source_type, self.worker_id)
+            if episode_id is None:
+                break
+            with self._in_flight_changed:
+                self.in_flight.add(episode_id)
+            episode = {"id": episode_id}
+            episode.update(load_episode(episode_id))
+            # blocks while the fetch stage is saturated
+            self.stages[0].queue.put({"episode": episode, "source_type": self.source_type})
+        with self._in_flight_changed:
+            self._in_flight_changed.wait_for(lambda: not self.in_flight)
+        for stage in self.stages:
+            stage.stop()
+        self._stopped.set()
+        self.print_report(time.time() - start)
+
+
+def load_episode(episode_id: int) -> dict:
+    return db.execute_query(
+        '''SELECT e.id, e.air_date, e.file_url FROM episode AS e WHERE e.id = %(id)s''',
+        {"id": episode_id}, "single_row"
+    ) or {}
+
+
+def run_staged_pipeline(source_type: SOURCE_TYPE, stage_workers: Optional[dict[str, int]] = None):
+    StagedPipeline(source_type, stage_workers).run()
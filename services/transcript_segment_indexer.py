@@ -0,0 +1,129 @@
+import re
+from typing import Optional
+
+from services.transcript_store import load_episode_transcripts
+from utils import db
+from utils.transcripts import iter_transcript_results, parse_offset, result_text
+
+HEBREW_PREFIXES = "והבלמשכ"
+MAX_PREFIX_LENGTH = 3
+MIN_STEM_LENGTH = 3
+
+NIQQUD = re.compile(r'[\u0591-\u05BD\u05BF\u05C1\u05C2\u05C4\u05C5\u05C7]')
+ACRONYM_QUOTES = re.compile(r'(?<=[\u05D0-\u05EA])["\'\u05F3\u05F4](?=[\u05D0-\u05EA])')
+WORD = re.compile(r'\w+')
+
+
+def strip_niqqud(text: str) -> str:
+    text = NIQQUD.sub("", text)
+    return ACRONYM_QUOTES.sub("", text)
+
+
+def prefix_variants(word: str) -> list[str]:
+    # "ושהבית" -> ["ושהבית", "שהבית", "הבית", "בית"], so a search for any of them hits the segment
+    variants = [word]
+    stem = word
+    for _ in range(MAX_PREFIX_LENGTH):
+        if stem[0] not in HEBREW_PREFIXES or len(stem) - 1 < MIN_STEM_LENGTH:
+            break
+        stem = stem[1:]
+        variants.append(stem)
+    return variants
+
+
+def normalize_hebrew(text: str) -> str:
+    words = WORD.findall(strip_niqqud(text).lower())
+    return " ".join(v for w in words for v in prefix_variants(w))
+
+
+def segment_search_expression(search_type: str, query: str) -> Optional[str]:
+    """Turns a search into a BOOLEAN MODE expression against transcript_segment.normalized_text."""
+    if not query:
+        return None
+    if search_type == "boolean":
+        return strip_niqqud(query).lower()
+    if search_type == "contains":
+        # every word required, as a prefix so inflected forms still hit; normalized_text interleaves prefix
+        # variants between the words, so adjacency and substrings are checked by segment_phrase_pattern
+        words = WORD.findall(strip_niqqud(query).lower())
+        return " ".join("+" + w + "*" for w in words) or None
+    return None
+
+
+def segment_phrase_pattern(search_type: str, query: str) -> Optional[str]:
+    """LIKE pattern on transcript_segment.text for a contains search, matching the query as a substring the way
+    the episode search always has; None for other search types."""
+    if search_type != "contains" or not WORD.findall(query or ""):
+        return None
+    return "%" + " ".join(query.split()) + "%"
+
+
+def explode_transcripts(parts: list) -> list[dict]:
+    rows = []
+    # parts with absolute offsets record where they start in the episode
+    previous_end = {i: (part[0].get("start_offset") or 0.0) if part else 0.0 for i, part in enumerate(parts)}
+    for part_index, segment_index, result in iter_transcript_results(parts):
+        text = result_text(result)
+        end_offset = parse_offset(result.get("offset"))
+        start_offset = previous_end[part_index]
+        if end_offset is not None:
+            previous_end[part_index] = end_offset
+        rows.append({
+            "part": part_index,
+            "segment": segment_index,
+            "start_offset": start_offset,
+            "end_offset": end_offset,
+            "text": text,
+            "normalized_text": normalize_hebrew(text),
+        })
+    return rows
+
+
+def index_episode_transcripts(episode_id: int, parts: Optional[list] = None):
+    if parts is None:
+        parts = load_episode_transcripts(episode_id) or []
+    rows = explode_transcripts(parts)
+    for r in rows:
+        r["episode_id"] = episode_id
+    # replaced in one transaction that raises on failure, so an episode never silently ends up without segments
+    with db.transaction() as cursor:
+        cursor.execute(
+            '''DELETE FROM transcript_segment WHERE episode_id = %(episode_id)s''',
+            {"episode_id": episode_id}
+        )
+        if rows:
+            cursor.executemany(
+                '''INSERT INTO transcript_segment (`episode_id`, `part`, `segment`, `start_offset`, `end_offset`, `text`, `normalized_text`)
+                VALUES (%(episode_id)s, %(part)s, %(segment)s, %(start_offset)s, %(end_offset)s, %(text)s, %(normalized_text)s)''',
+                rows
+            )
+    return len(rows)
+
+
+def backfill_transcript_segments():
+    last_id = 0
+    indexed_count = 0
+    while True:
+        episode = db.execute_query(
+            '''SELECT e.id
+            FROM episode AS e
+            WHERE e.id > %(last_id)s
+             AND e.has_transcript = 1
+             AND NOT EXISTS (SELECT 1 FROM transcript_segment AS ts WHERE ts.episode_id = e.id)
+            ORDER BY e.id
+            LIMIT 1
+            ''',
+            {"last_id": last_id}, "single_row"
+        )
+        if episode is None:
+            break
+        last_id = episode["id"]
+        segment_count = index_episode_transcripts(episode["id"])
+        indexed_count += 1
+        print("indexed " + str(segment_count) + " segments of episode " + str(episode["id"]))
+    print("indexed " + str(indexed_count) + " episodes")
+    return indexed_count
+
+
+if __name__ == "__main__":
+    backfill_transcript_segments()
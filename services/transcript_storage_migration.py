@@ -0,0 +1,82 @@
+import sys
+
+from services.transcript_segment_indexer import index_episode_transcripts
+from services.transcript_store import load_stored_transcripts, save_episode_transcripts
+from utils import db
+from utils.transcripts import load_transcripts, parse_offset
+
+MIGRATE_BATCH_SIZE = 50
+
+
+def offsets_normalized(parts: list) -> list:
+    """The transcripts with every result offset as whole milliseconds, the one thing the stored format may
+    spell differently; any other difference from the source is a loss."""
+    normalized = []
+    for part in parts:
+        responses = []
+        for response in part or []:
+            response = dict(response)
+            if isinstance(response.get("transcript"), dict) and isinstance(response["transcript"].get("results"), list):
+                results = []
+                for result in response["transcript"]["results"]:
+                    offset = parse_offset(result.get("offset"))
+                    results.append(dict(result, offset=None if offset is None else round(offset * 1000)))
+                response["transcript"] = dict(response["transcript"], results=results)
+            responses.append(response)
+        normalized.append(responses)
+    return normalized
+
+
+def migrate_transcripts(clear_source: bool = False) -> int:
+    """Copies inline transcripts into episode_transcript, indexing any episode missing from transcript_segment
+    on the way. With clear_source the inline copies are dropped and the episode table rebuilt afterwards."""
+    last_id = 0
+    migrated = 0
+    raw_bytes = 0
+    stored_bytes = 0
+    while True:
+        episodes = db.execute_query(
+            '''SELECT e.id, e.transcripts,
+                      EXISTS (SELECT 1 FROM transcript_segment AS ts WHERE ts.episode_id = e.id) AS indexed
+            FROM episode AS e
+            WHERE e.id > %(last_id)s
+             AND e.transcripts IS NOT NULL
+            ORDER BY e.id
+            LIMIT %(batch_size)s
+            ''',
+            {"last_id": last_id, "batch_size": MIGRATE_BATCH_SIZE}, "rows"
+        )
+        if not episodes:
+            break
+        last_id = episodes[-1]["id"]
+        args = {}
+        for i, e in enumerate(episodes):
+            parts = load_transcripts(e["transcripts"])
+            stats = save_episode_transcripts(e["id"], parts)
+            # read from episode_transcript alone, the inline fallback would make a missing row look migrated
+            stored = load_stored_transcripts([e["id"]]).get(e["id"])
+            if stored is None:
+                raise RuntimeError("transcripts of episode " + str(e["id"]) + " were not stored")
+            if offsets_normalized(stored) != offsets_normalized(parts):
+                raise RuntimeError("stored transcripts of episode " + str(e["id"]) + " differ from the source")
+            if not e["indexed"]:
+                index_episode_transcripts(e["id"], parts)
+            raw_bytes += len(e["transcripts"].encode("utf8") if isinstance(e["transcripts"], str) else e["transcripts"])
+            stored_bytes += stats["stored_bytes"]
+            args["id_" + str(i)] = e["id"]
+        db.execute_query(
+            "UPDATE episode SET has_transcript = 1" + (", transcripts = NULL" if clear_source else "") +
+            " WHERE id IN (" + ", ".join("%(" + k + ")s" for k in args) + ")",
+            args, "none"
+        )
+        migrated += len(episodes)
+        print("migrated " + str(migrated) + " episodes, " +
+              f"{raw_bytes / 1e6:.1f}MB -> {stored_bytes / 1e6:.1f}MB")
+    if clear_source and migrated:
+        print("rebuilding the episode table")
+        db.execute_query("OPTIMIZE TABLE episode", {}, "rows")
+    return migrated
+
+
+if __name__ == "__main__":
+    migrate_transcripts(clear_source="--clear-source" in sys.argv)
@@ -0,0 +1,124 @@
+import json
+import os
+import zlib
+from datetime import timedelta
+from typing import Optional
+
+from utils import db
+from utils.transcripts import load_transcripts, parse_offset
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# "episode" keeps transcripts as JSON text in episode.transcripts, "table" writes them compressed to
+# episode_transcript and searches them through transcript_segment
+TRANSCRIPT_STORAGE = os.getenv("TRANSCRIPT_STORAGE", "episode")
+FORMAT_VERSION = 1
+ZSTD_LEVEL = 10
+
+
+def compact_transcripts(parts: list) -> list:
+    """Shrinks [[{transcript: {results: [{offset, alternatives}]}, ...}]] to [[{r: [[offset_ms, *alternatives]], ...}]],
+    keeping any other keys of a response as they are."""
+    compact = []
+    for part in parts:
+        responses = []
+        for response in part or []:
+            results = []
+            for result in (response.get("transcript") or {}).get("results") or []:
+                offset = parse_offset(result.get("offset"))
+                results.append([None if offset is None else round(offset * 1000)] + list(result.get("alternatives") or []))
+            responses.append(dict({k: v for k, v in response.items() if k != "transcript"}, r=results))
+        compact.append(responses)
+    return compact
+
+
+def expand_transcripts(compact: list) -> list:
+    parts = []
+    for part in compact:
+        responses = []
+        for response in part:
+            results = [{
+                "offset": None if r[0] is None else str(timedelta(milliseconds=r[0])),
+                "alternatives": r[1:],
+            } for r in response["r"]]
+            responses.append(dict({k: v for k, v in response.items() if k != "r"}, transcript={"results": results}))
+        parts.append(responses)
+    return parts
+
+
+def compress(raw: bytes) -> tuple[str, bytes]:
+    if zstandard is not None:
+        return "zstd", zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(raw)
+    return "zlib", zlib.compress(raw, 9)
+
+
+def decompress(codec: str, data: bytes) -> bytes:
+    if codec == "zstd":
+        if zstandard is None:
+            raise ImportError("zstandard is required to read zstd compressed transcripts")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+def save_episode_transcripts(episode_id: int, parts: list) -> dict:
+    """Raises if the row could not be written, callers drop the inline copy only after this succeeded."""
+    raw = json.dumps(compact_transcripts(parts), ensure_ascii=False, separators=(",", ":")).encode("utf8")
+    codec, data = compress(raw)
+    with db.transaction() as cursor:
+        cursor.execute(
+            '''REPLACE INTO episode_transcript (`episode_id`, `format_version`, `codec`, `parts`, `raw_bytes`, `data`)
+            VALUES (%(episode_id)s, %(format_version)s, %(codec)s, %(parts)s, %(raw_bytes)s, %(data)s)''',
+            {"episode_id": episode_id, "format_version": FORMAT_VERSION, "codec": codec, "parts": len(parts),
+             "raw_bytes": len(raw), "data": data}
+        )
+    return {"raw_bytes": len(raw), "stored_bytes": len(data)}
+
+
+def load_stored_transcripts(episode_ids: list[int]) -> dict[int, list]:
+    """Transcripts read from episode_transcript only, without falling back to episode.transcripts."""
+    if not episode_ids:
+        return {}
+    args = {"id_" + str(i): episode_id for i, episode_id in enumerate(episode_ids)}
+    stored = db.execute_query(
+        '''SELECT t.episode_id, t.codec, t.data FROM episode_transcript AS t
+        WHERE t.episode_id IN (''' + ", ".join("%(" + k + ")s" for k in args) + ")",
+        args, "rows"
+    ) or []
+    return {row["episode_id"]: expand_transcripts(json.loads(decompress(row["codec"], row["data"]))) for row in stored}
+
+
+def load_episodes_transcripts(episode_ids: list[int]) -> dict[int, list]:
+    """Transcripts of the episodes that have any, read from episode_transcript and, for episodes not migrated
+    yet, from episode.transcripts."""
+    if not episode_ids:
+        return {}
+    args = {"id_" + str(i): episode_id for i, episode_id in enumerate(episode_ids)}
+    transcripts = load_stored_transcripts(episode_ids)
+    missing = {k: v for k, v in args.items() if v not in transcripts}
+    if missing:
+        inline = db.execute_query(
+            '''SELECT e.id, e.transcripts FROM episode AS e
+            WHERE e.id IN (''' + ", ".join("%(" + k + ")s" for k in missing) + ''')
+             AND e.transcripts IS NOT NULL''',
+            missing, "rows"
+        ) or []
+        for row in inline:
+            transcripts[row["id"]] = load_transcripts(row["transcripts"])
+    return transcripts
+
+
+def load_episode_transcripts(episode_id: int) -> Optional[list]:
+    return load_episodes_transcripts([episode_id]).get(episode_id)
+
+
+def fill_transcripts(rows: list[dict], as_json: bool = True):
+    """Sets "transcripts" on episode rows read without them (rows that already carry inline transcripts are
+    left alone), as the JSON text the API has always returned or as the parsed parts."""
+    missing = [r["id"] for r in rows if r.get("transcripts") is None and r.get("has_transcript")]
+    loaded = load_episodes_transcripts(missing)
+    for r in rows:
+        if r["id"] in loaded:
+            r["transcripts"] = json.dumps(loaded[r["id"]], ensure_ascii=False) if as_json else loaded[r["id"]]
@@ -0,0 +1,138 @@
+import json
+import time
+
+from episode_transcriber import OperationFailed, collect_batch_recognize, gcs_uri
+from google_cloud_storage_manager import delete_blobs
+from services.episode_downloader import load_segment_offsets, restore_original_offsets, set_episode_download_status, \
+    store_transcripts
+from utils import db
+
+POLL_MIN_INTERVAL = 30
+POLL_MAX_INTERVAL = 600
+
+
+def pending_operations() -> list[str]:
+    rows = db.execute_query(
+        '''SELECT DISTINCT j.operation_name
+        FROM transcription_job AS j
+        WHERE j.status = 'submitted'
+        ''',
+        {}, "rows"
+    ) or []
+    return [r["operation_name"] for r in rows]
+
+
+def collect_operation(operation_name: str) -> bool:
+    """Stores the results of a finished operation on its jobs; returns False while it is still running or
+    could not be checked, leaving its jobs submitted for the next poll."""
+    try:
+        results = collect_batch_recognize(operation_name)
+    except OperationFailed as e:
+        print("transcription operation " + operation_name + " failed: " + str(e))
+        db.execute_query(
+            '''UPDATE transcription_job SET status = 'error', err_msg = %(error)s
+            WHERE operation_name = %(operation_name)s AND status = 'submitted'
+            ''',
+            {"operation_name": operation_name, "error": str(e)[0:500]}, "none"
+        )
+        return True
+    except Exception as e:
+        print("could not check transcription operation " + operation_name + ": " + str(e))
+        return False
+    if results is None:
+        return False
+    jobs = db.execute_query(
+        '''SELECT j.id, j.gcs_object FROM transcription_job AS j
+        WHERE j.operation_name = %(operation_name)s AND j.status = 'submitted'
+        ''',
+        {"operation_name": operation_name}, "rows"
+    ) or []
+    for job in jobs:
+        result = results.get(gcs_uri(job["gcs_object"]), "no transcription returned")
+        if isinstance(result, str):
+            status, transcript, error = "error", None, result[0:500]
+        else:
+            status, transcript, error = "done", json.dumps(result, ensure_ascii=False), None
+        db.execute_query(
+            '''UPDATE transcription_job SET status = %(status)s, transcript = %(transcript)s, err_msg = %(error)s
+            WHERE id = %(id)s
+            ''',
+            {"id": job["id"], "status": status, "transcript": transcript, "error": error}, "none"
+        )
+    return True
+
+
+def store_finished_episodes() -> int:
+    """Writes the transcript of every episode whose parts have all finished, through the same path
+    a synchronous worker uses."""
+    episodes = db.execute_query(
+        '''SELECT j.episode_id,
+                  SUM(j.status = 'done') AS done_count,
+                  SUM(j.status = 'error') AS error_count,
+                  COUNT(*) AS part_count
+        FROM transcription_job AS j
+        WHERE j.status IN ('submitted', 'done', 'error')
+        GROUP BY j.episode_id
+        HAVING done_count + error_count = part_count
+        ''',
+        {}, "rows"
+    ) or []
+    stored = 0
+    for e in episodes:
+        episode_id = e["episode_id"]
+        # one episode that cannot be stored must not stop the poller, it is retried on the next poll
+        try:
+            jobs = db.execute_query(
+                '''SELECT j.* FROM transcription_job AS j
+                WHERE j.episode_id = %(episode_id)s AND j.status IN ('done', 'error')
+                ORDER BY j.part
+                ''',
+                {"episode_id": episode_id}, "rows"
+            ) or []
+            if len(jobs) != e["part_count"]:
+                raise RuntimeError("read " + str(len(jobs)) + " of " + str(e["part_count"]) + " parts")
+            if e["error_count"]:
+                errors = "; ".join(j["err_msg"] or "" for j in jobs if j["status"] == "error")
+                set_episode_download_status(episode_id, "error", ("transcription failed: " + errors)[0:300])
+            else:
+                segment_offsets = load_segment_offsets(episode_id)
+                transcript_parts = []
+                for j in jobs:
+                    segment_transcript = json.loads(j["transcript"])
+                    restore_original_offsets(segment_transcript, json.loads(j["kept_intervals"] or "null"),
+                                             segment_offsets[j["part"]] if segment_offsets else None)
+                    transcript_parts.append(segment_transcript)
+                store_transcripts(episode_id, transcript_parts)
+            delete_blobs([j["gcs_object"] for j in jobs])
+            # a failed episode's jobs are dropped so reprocessing the episode submits them afresh
+            db.execute_query(
+                '''DELETE FROM transcription_job WHERE episode_id = %(episode_id)s''' if e["error_count"] else
+                '''UPDATE transcription_job SET status = 'stored', transcript = NULL
+                WHERE episode_id = %(episode_id)s
+                ''',
+                {"episode_id": episode_id}, "none"
+            )
+            stored += 1
+        except Exception as error:
+            print("could not store transcription of episode " + str(episode_id) + ": " + str(error))
+    return stored
+
+
+def poll_transcription_jobs(run_forever: bool = True):
+    """Collects finished operations, backing off while nothing finishes. All state lives in the
+    transcription_job table, so a restarted poller picks up where the previous one stopped."""
+    interval = POLL_MIN_INTERVAL
+    while True:
+        operations = pending_operations()
+        finished = sum(1 for operation_name in operations if collect_operation(operation_name))
+        stored = store_finished_episodes()
+        if stored:
+            print("stored transcripts of " + str(stored) + " episodes")
+        if not run_forever and not operations:
+            return
+        interval = POLL_MIN_INTERVAL if finished else min(interval * 2, POLL_MAX_INTERVAL)
+        time.sleep(interval)
+
+
+if __name__ == "__main__":
+    poll_transcription_jobs()
@@ -0,0 +1,59 @@
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Literal, Optional
+
+from starlette.requests import Request
+
+from utils import db
+
+# threads running queries for the API, kept below the connection pool size so killing a query always finds
+# a free connection
+DB_THREADS = int(os.getenv("DB_THREADS", 16))
+DB_QUERY_TIMEOUT = float(os.getenv("DB_QUERY_TIMEOUT", 30))
+DISCONNECT_POLL_SECONDS = 0.5
+
+db_executor = ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix="db")
+
+
+class QueryTimeout(Exception):
+    pass
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+async def run(func, *args):
+    """Runs blocking database work, such as a db.transaction() block, on the DB thread pool."""
+    return await asyncio.get_running_loop().run_in_executor(db_executor, functools.partial(func, *args))
+
+
+async def execute_query(query, args, return_type: Literal["single_row", "rows", "id", "none"] = "rows",
+                        request: Optional[Request] = None, timeout: float = DB_QUERY_TIMEOUT):
+    """db.execute_query on the bounded DB thread pool, so the event loop keeps serving other requests.
+
+    The query is killed on the server once it runs longer than timeout (QueryTimeout) or the client of the
+    request goes away (ClientDisconnected).
+    """
+    loop = asyncio.get_running_loop()
+    tracker = db.QueryTracker()
+    future = loop.run_in_executor(db_executor, functools.partial(db.execute_query, query, args, return_type, tracker))
+    deadline = loop.time() + timeout
+    try:
+        while True:
+            done, _ = await asyncio.wait({future}, timeout=min(DISCONNECT_POLL_SECONDS, max(deadline - loop.time(), 0)))
+            if done:
+                return future.result()
+            if loop.time() >= deadline:
+                raise QueryTimeout("query ran for more than " + str(timeout) + " seconds")
+            if request is not None and await request.is_disconnected():
+                raise ClientDisconnected()
+    except BaseException:
+        # a query still queued behind busy DB threads is dropped before it starts; one already running raises
+        # QueryInterrupted in its worker thread once killed, nobody is waiting for it anymore
+        future.cancel()
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        await asyncio.to_thread(tracker.kill)
+        raise
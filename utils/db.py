@@ -1,5 +1,7 @@
 import os
-from typing import Literal
+import threading
+from contextlib import contextmanager
+from typing import Literal, Optional
 
 from dotenv import load_dotenv
 import mysql
@@ -12,8 +14,11 @@ PASSWORD = os.getenv("DB_PASS")
 DB_NAME = os.getenv("DB_NAME")
 DB_PORT = os.getenv("DB_PORT")
 DB_HOST = os.getenv("DB_HOST")
+# connections per process; mysql-connector caps a pool at 32, and get_connection fails rather than waits when
+# every connection is taken, so threads that query at the same time must fit in it
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 20))
 
-cnx_pool = mysql.connector.pooling.MySQLConnectionPool(pool_name="connections", pool_size=20,
+cnx_pool = mysql.connector.pooling.MySQLConnectionPool(pool_name="connections", pool_size=DB_POOL_SIZE,
                                                        pool_reset_session=True,
                                                        host=DB_HOST,
                                                        port=DB_PORT,
@@ -22,8 +27,47 @@ cnx_pool = mysql.connector.pooling.MySQLConnectionPool(pool_name="connections",
                                                        password=PASSWORD)
 
 
-def execute_query(query, args, return_type: Literal["single_row", "rows", "id", "none"] = "rows"):
+class QueryInterrupted(Exception):
+    pass
+
+
+class QueryTracker:
+    """Lets another thread kill a query while it runs on its pooled connection. The connection id is only
+    held while the query runs, so a kill can never reach a connection already handed to someone else."""
+
+    def __init__(self):
+        self.connection_id = None
+        self.killed = False
+        self._lock = threading.Lock()
+
+    def attach(self, connection_id: int):
+        with self._lock:
+            # killed before the query got a connection, it must not start at all
+            if self.killed:
+                raise QueryInterrupted("query killed before it started")
+            self.connection_id = connection_id
+
+    def detach(self):
+        with self._lock:
+            self.connection_id = None
+
+    def kill(self):
+        with self._lock:
+            self.killed = True
+            if self.connection_id is None:
+                return
+            execute_query("KILL QUERY " + str(int(self.connection_id)), {}, "none")
+
+
+def execute_query(query, args, return_type: Literal["single_row", "rows", "id", "none"] = "rows",
+                  tracker: Optional[QueryTracker] = None):
     cnx = cnx_pool.get_connection()
+    if tracker is not None:
+        try:
+            tracker.attach(cnx.connection_id)
+        except QueryInterrupted:
+            cnx.close()
+            raise
     cursor = cnx.cursor(buffered=True)
     try:
         cursor.execute(query, args)
@@ -37,6 +81,50 @@ def execute_query(query, args, return_type: Literal["single_row", "rows", "id",
                 return False
             return last_row_id
         return None
+    except mysql.connector.Error as err:
+        if tracker is not None and tracker.killed:
+            raise QueryInterrupted(str(err)) from err
+        print(err)
+        return False
+    finally:
+        if tracker is not None:
+            tracker.detach()
+        try:
+            cursor.close()
+            cnx.commit()
+            cnx.close()
+        except mysql.connector.Error as err:
+            print(err)
+
+
+@contextmanager
+def transaction():
+    """Yields a cursor whose statements all commit together when the block ends, or roll back if it raises."""
+    cnx = cnx_pool.get_connection()
+    cursor = cnx.cursor(buffered=True)
+    try:
+        cnx.start_transaction()
+        yield cursor
+        cnx.commit()
+    except BaseException:
+        cnx.rollback()
+        raise
+    finally:
+        try:
+            cursor.close()
+            cnx.close()
+        except mysql.connector.Error as err:
+            print(err)
+
+
+def execute_many(query, args_list: list):
+    if not args_list:
+        return 0
+    cnx = cnx_pool.get_connection()
+    cursor = cnx.cursor(buffered=True)
+    try:
+        cursor.executemany(query, args_list)
+        return cursor.rowcount
     except mysql.connector.Error as err:
         print(err)
         return False
@@ -0,0 +1,41 @@
+import json
+import re
+from typing import Iterator, Optional, Union
+
+OFFSET_PATTERN = re.compile(r'^(?:(\d+) days?, )?(\d+):(\d{1,2}):(\d{1,2}(?:\.\d+)?)$')
+
+
+def load_transcripts(transcripts: Optional[Union[str, bytes, list]]) -> list:
+    if not transcripts:
+        return []
+    if isinstance(transcripts, list):
+        return transcripts
+    return json.loads(transcripts)
+
+
+def iter_transcript_results(parts: list) -> Iterator[tuple[int, int, dict]]:
+    """Walks the stored transcripts structure, one list per part of
+    [{transcript: {results: [{offset, alternatives}]}}], yielding (part, segment, result)."""
+    for part_index, part in enumerate(parts):
+        segment_index = 0
+        for response in part or []:
+            for result in (response.get("transcript") or {}).get("results") or []:
+                yield part_index, segment_index, result
+                segment_index += 1
+
+
+def result_text(result: dict) -> str:
+    return (result.get("alternatives") or [""])[0] or ""
+
+
+def parse_offset(offset: Optional[Union[str, int, float]]) -> Optional[float]:
+    """Converts an offset stored as str(timedelta), e.g. "0:01:23.450000", to seconds."""
+    if offset is None:
+        return None
+    if isinstance(offset, (int, float)):
+        return float(offset)
+    match = OFFSET_PATTERN.match(offset.strip())
+    if not match:
+        return None
+    days, hours, minutes, seconds = match.groups()
+    return int(days or 0) * 86400 + int(hours) * 3600 + int(minutes) * 60 + float(seconds)